@@ -22,11 +22,13 @@
 
 '''Halostack CLI main.'''
 
-from halostack.stack import Stack
-from halostack.image import Image
-from halostack.align import Align
+from halostack.stack import Stack, StackSet
+from halostack.image import Image, AsyncWriter, FrameCache
+from halostack.align import Align, AlignCache, select_reference
+from halostack.pool import worker_pool
 from halostack.helpers import (get_filenames, parse_enhancements,
-                               get_two_points, read_config, intermediate_fname)
+                               get_two_points, read_config, intermediate_fname,
+                               prefetch, parse_area)
 from halostack import __version__
 
 import argparse
@@ -76,6 +78,10 @@ LOG_CONFIG = {
             'level': 'DEBUG',
             'handlers': ['file', 'console'],
             },
+        'halostack.pool': {
+            'level': 'DEBUG',
+            'handlers': ['file', 'console'],
+            },
         }
     }
 
@@ -87,101 +93,156 @@ def halostack_cli(args):
 
     images = args['fname_in']
 
-    stacks = []
+    stacks = StackSet()
     for i in range(len(args['stacks'])):
         stacks.append(Stack(args['stacks'][i], len(images),
                             nprocs=args['nprocs'],
                             kwargs=args['stack_kwargs'][i]))
 
+    cache = None
+    if args['cache_dir'] is not None:
+        cache = FrameCache(args['cache_dir'],
+                           max_size=args['cache_size'] * 1024**2)
+
     base_img_fname = images[0]
-    base_img = Image(fname=base_img_fname, nprocs=args['nprocs'])
+    base_img = Image(fname=base_img_fname, nprocs=args['nprocs'],
+                     cache=cache)
     LOGGER.debug("Using %s as base image.", base_img.fname)
     images.remove(images[0])
 
     if not args['no_alignment'] and len(images) > 0:
-        view_img = base_img.luminance()
-        if isinstance(args['view_gamma'], float):
-            from halostack.image import _scale
-            view_img.enhance({'gamma': args['view_gamma']})
-            view_img.img = _scale(view_img.img, bits=8)
-        print "\nClick tight area (two opposite corners) for "\
-            "reference location.\n"
-        args['focus_reference'] = get_two_points(view_img)
+        if args['focus_reference'] is None and \
+                args['auto_reference'] is not None:
+            args['focus_reference'] = \
+                select_reference(base_img, args['auto_reference'],
+                                 area=args['focus_area'])
+        elif args['focus_reference'] is None:
+            view_img = base_img.luminance()
+            if isinstance(args['view_gamma'], float):
+                from halostack.image import _scale
+                view_img.enhance({'gamma': args['view_gamma']})
+                view_img.img = _scale(view_img.img, bits=8)
+            print "\nClick tight area (two opposite corners) for "\
+                "reference location.\n"
+            args['focus_reference'] = get_two_points(view_img)
+            if args['focus_area'] is None:
+                print "Click two corner points for the area where "\
+                    "alignment reference will be in every image.\n"
+                args['focus_area'] = get_two_points(view_img)
+            del view_img
         LOGGER.debug("Reference area: (%d, %d) with radius %d.",
                      args['focus_reference'][0],
                      args['focus_reference'][1],
                      args['focus_reference'][2])
-        print "Click two corner points for the area where alignment "\
-            "reference will be in every image.\n"
-        args['focus_area'] = get_two_points(view_img)
 
-        LOGGER.debug("User-selected search area: (%d, %d) with radius %d.",
-                    args['focus_area'][0],
-                    args['focus_area'][1],
-                    args['focus_area'][2])
-        del view_img
+        if args['focus_area'] is None:
+            # Search from the whole image
+            shape = base_img.shape
+            args['focus_area'] = [shape[1]//2, shape[0]//2,
+                                  max(shape[:2])//2]
+        LOGGER.debug("Search area: (%d, %d) with radius %d.",
+                     args['focus_area'][0],
+                     args['focus_area'][1],
+                     args['focus_area'][2])
 
     aligner = None
     if not args['no_alignment'] and len(images) > 0:
         LOGGER.debug("Initializing alignment.")
+        align_cache = None
+        if args['align_cache'] is not None:
+            align_cache = AlignCache(args['align_cache'])
         aligner = Align(base_img,
                         cor_th=args['correlation_threshold'],
-                        nprocs=args['nprocs'])
+                        mode=args['alignment_mode'],
+                        nprocs=args['nprocs'],
+                        subpixel=args['subpixel'],
+                        cache=align_cache)
         aligner.set_reference(args['focus_reference'])
         aligner.set_search_area(args['focus_area'])
         LOGGER.debug("Alignment initialized.")
 
+    # Intermediate images are saved in background
+    writer = None
     if args['save_prefix'] is not None:
+        writer = AsyncWriter(threads=args['nprocs'])
         fname = intermediate_fname(args['save_prefix'], base_img_fname)
-        base_img.save(fname)
+        writer.save(base_img, fname, compression=args['compression'])
 
     if len(args['enhance_images']) > 0:
         LOGGER.info("Preprocessing image.")
         base_img.enhance(args['enhance_images'])
 
-    for stack in stacks:
-        stack.add_image(base_img)
+    stacks.add_image(base_img)
 
     # memory management
     del base_img
     base_img = None
 
-    skipped_images = []
-    for img_fname in images:
-        # Read image
-        img = Image(fname=img_fname, nprocs=args['nprocs'])
+    def _read(img_fname):
+        '''Read image.'''
+        return img_fname, Image(fname=img_fname, nprocs=args['nprocs'],
+                                cache=cache)
 
+    def _process(data):
+        '''Align, save and preprocess image.'''
+        img_fname, img = data
+        weight = 1.0
         if not args['no_alignment'] and len(images) > 1:
             # align image
             img = aligner.align(img)
+            weight = aligner.correlation
 
         if img is None:
-            LOGGER.warning("Skipping image.")
-            skipped_images.append(img_fname)
-            continue
+            return img_fname, None, weight
 
         if args['save_prefix'] is not None:
             fname = intermediate_fname(args['save_prefix'], img_fname)
-            img.save(fname)
+            writer.save(img, fname, compression=args['compression'])
 
         if len(args['enhance_images']) > 0:
             LOGGER.info("Preprocessing image.")
             img.enhance(args['enhance_images'])
 
-        for stack in stacks:
-            stack.add_image(img)
+        return img_fname, img, weight
+
+    # Next images are read in background while the current one is
+    # processed, and the next image is aligned in its own thread while
+    # the current one is stacked
+    frames = prefetch(_read, images, depth=args['prefetch'])
+    frames = prefetch(_process, frames, depth=min(1, args['prefetch']),
+                      threads=1)
+
+    skipped_images = []
+    for img_fname, img, weight in frames:
+        if img is None:
+            LOGGER.warning("Skipping image.")
+            skipped_images.append(img_fname)
+            continue
+
+        stacks.add_image(img, weight=weight)
 
         del img
         img = None
 
+    if aligner is not None and aligner.cache is not None:
+        aligner.cache.save()
+
+    # memory management
     if aligner is not None:
-        del aligner
-        aligner = None
+        aligner.close()
+    aligner = None
 
-    for i in range(len(stacks)):
-        img = stacks[i].calculate()
-        img.save(args['stack_fnames'][i],
-                 enhancements=args['enhance_stacks'])
+    if writer is not None:
+        writer.close()
+
+    for stack, fname in zip(stacks, args['stack_fnames']):
+        try:
+            img = stack.calculate()
+        except ValueError as err:
+            LOGGER.error("%s, %s not saved.", err, fname)
+            continue
+        img.save(fname, enhancements=args['enhance_stacks'],
+                 compression=args['compression'])
 
     if len(images) > 1:
         LOGGER.info("Stacked %d/%d images.", len(images)+1-len(skipped_images),
@@ -197,6 +258,21 @@ def main():
     parser.add_argument("-a", "--average-stack", dest="avg_stack_file",
                         default=None, metavar="FILE",
                         help="Output filename of the average stack")
+    parser.add_argument("--compensated-mean", dest="compensated_mean",
+                        default=None, action="store_true",
+                        help="Use compensated summation for the average "
+                        "stack")
+    parser.add_argument("--weighted-stack", dest="wmean_stack_file",
+                        default=None, metavar="FILE",
+                        help="Output filename of the average stack weighted "
+                        "with the alignment correlation")
+    parser.add_argument("--std-stack", dest="std_stack_file",
+                        default=None, metavar="FILE",
+                        help="Output filename of the standard deviation "
+                        "stack")
+    parser.add_argument("--var-stack", dest="var_stack_file",
+                        default=None, metavar="FILE",
+                        help="Output filename of the variance stack")
     parser.add_argument("-m", "--min-stack", dest="min_stack_file",
                         default=None, metavar="FILE",
                         help="Output filename of the minimum stack")
@@ -206,20 +282,71 @@ def main():
     parser.add_argument("-d", "--median-stack", dest="median_stack_file",
                         default=None, metavar="FILE",
                         help="Output filename of the median stack")
+    parser.add_argument("--approx-median-stack",
+                        dest="approx_median_stack_file",
+                        default=None, metavar="FILE",
+                        help="Output filename of the approximate median "
+                        "stack")
+    parser.add_argument("--median-bins", dest="median_bins",
+                        default=None, metavar="INT", type=int,
+                        help="Number of histogram bins for the approximate "
+                        "median stack.  More bins give a smaller error but "
+                        "use more memory, 1-4 bytes per bin for each pixel "
+                        "and channel [as much memory as the images would "
+                        "use, 16-256 bins]")
     parser.add_argument("-S", "--sigma-stack", dest="sigma_stack_file",
                         default=None, metavar="FILE",
                         help="Output filename of the kappa-sigma stack")
     parser.add_argument("-k", "--kappa-sigma-params", dest="kappa_sigma_params",
                         default=None, metavar="KAPPA,ITERATIONS",
                         help="Kappa and iterations for the kappa-sigma stack")
+    parser.add_argument("--tmpdir", dest="tmpdir", default=None,
+                        metavar="DIR",
+                        help="Store the median and kappa-sigma stacks to a "
+                        "temporary file in DIR instead of memory")
+    parser.add_argument("--memory", dest="memory", default=None,
+                        metavar="MB", type=int,
+                        help="Memory budget for calculating the disk-backed "
+                        "stacks [1024]")
+    parser.add_argument("--storage-dtype", dest="storage_dtype",
+                        default=None, metavar="STR",
+                        help="Data type for storing the images of the "
+                        "median and kappa-sigma stacks, eg. uint16")
     parser.add_argument("-t", "--correlation-threshold",
                         dest="correlation_threshold",
                         default=None, metavar="NUM", type=float,
                         help="Minimum required correlation [0.7]")
+    parser.add_argument("-A", "--alignment-mode", dest="alignment_mode",
+                        default=None, metavar="STR",
+                        help="Alignment method: simple, fft, pyramid or "
+                        "rotation [simple]")
+    parser.add_argument("--focus-reference", dest="focus_reference",
+                        default=None, metavar="X,Y,R",
+                        help="Center and radius of the alignment reference "
+                        "area.  Selected interactively if not given")
+    parser.add_argument("--focus-area", dest="focus_area",
+                        default=None, metavar="X,Y,R",
+                        help="Center and radius of the area where the "
+                        "reference is searched [whole image]")
+    parser.add_argument("--auto-reference", dest="auto_reference",
+                        default=None, metavar="R", type=int,
+                        help="Select alignment reference of radius R "
+                        "automatically")
+    parser.add_argument("--subpixel", dest="subpixel",
+                        default=None, action="store_true",
+                        help="Align images with sub-pixel accuracy")
+    parser.add_argument("--align-cache", dest="align_cache",
+                        default=None, metavar="FILE",
+                        help="Store the alignments to FILE and reuse them "
+                        "on later runs")
     parser.add_argument("-s", "--save-images", dest="save_prefix",
                         default=None, metavar="STR",
                         help="Save aligned images as PNG with the given " \
                             "filename postfix")
+    parser.add_argument("--compression", dest="compression",
+                        default=None, metavar="INT", type=int,
+                        help="Compression level of the saved PNG and TIFF "
+                        "images, from 0 (fastest) to 9 (smallest) [6]")
     parser.add_argument("-n", "--no-alignment", dest="no_alignment",
                         default=None, action="store_true",
                         help="Stack without alignment")
@@ -240,6 +367,15 @@ def main():
     parser.add_argument("-p", "--nprocs", dest="nprocs", metavar="INT",
                         type=int, default=None,
                         help="Number of parallel processes")
+    parser.add_argument("--prefetch", dest="prefetch", metavar="INT",
+                        type=int, default=None,
+                        help="Number of images read ahead in background [2]")
+    parser.add_argument("--cache-dir", dest="cache_dir", metavar="DIR",
+                        default=None,
+                        help="Cache the decoded images to DIR for later runs")
+    parser.add_argument("--cache-size", dest="cache_size", metavar="MB",
+                        type=int, default=None,
+                        help="Maximum size of the image cache [10240]")
     parser.add_argument("-v", "--version", action="version",
                         version="Halostack %s" % (__version__))
     parser.add_argument('fname_in', metavar="FILE", type=str, nargs='*',
@@ -252,6 +388,10 @@ def main():
     if args["config_item"] is not None:
         args = read_config(args)
 
+    # Alignment areas given on commandline or in config file
+    args['focus_reference'] = parse_area(args['focus_reference'])
+    args['focus_area'] = parse_area(args['focus_area'])
+
     # Check which adjustments are made for each image, and then for
     # the resulting stacks
     args['enhance_images'] = parse_enhancements(args['enhance_images'])
@@ -265,8 +405,18 @@ def main():
     # Check validity
     if not isinstance(args['nprocs'], int):
         args['nprocs'] = 1
+    if not isinstance(args['cache_size'], int):
+        args['cache_size'] = 10240
+    if not isinstance(args['compression'], int):
+        args['compression'] = 6
+    if not isinstance(args['prefetch'], int):
+        args['prefetch'] = 2
     if not isinstance(args['correlation_threshold'], float):
         args['correlation_threshold'] = 0.7
+    if args['alignment_mode'] is None:
+        args['alignment_mode'] = 'simple'
+    if not isinstance(args['subpixel'], bool):
+        args['subpixel'] = False
     if not isinstance(args['no_alignment'], bool):
         args['no_alignment'] = False
     if platform.system() == 'Windows':
@@ -274,6 +424,16 @@ def main():
                        "so limiting to one processor.")
         args['nprocs'] = 1
 
+    # Keyword arguments for the deep stacks
+    deep_kwargs = {}
+    if args['tmpdir'] is not None:
+        deep_kwargs['disk'] = True
+        deep_kwargs['tmpdir'] = args['tmpdir']
+        if isinstance(args['memory'], int):
+            deep_kwargs['memory'] = args['memory']
+    if args['storage_dtype'] is not None:
+        deep_kwargs['dtype'] = args['storage_dtype']
+
     # Check which stacks will be made
     stacks = []
     stack_fnames = []
@@ -291,22 +451,48 @@ def main():
     if args['avg_stack_file']:
         stacks.append('mean')
         stack_fnames.append(args['avg_stack_file'])
-        stack_kwargs.append(None)
+        if args['compensated_mean']:
+            stack_kwargs.append({'compensated': True})
+        else:
+            stack_kwargs.append(None)
         LOGGER.debug("Added average stack")
+    if args['wmean_stack_file']:
+        stacks.append('wmean')
+        stack_fnames.append(args['wmean_stack_file'])
+        stack_kwargs.append(None)
+        LOGGER.debug("Added weighted average stack")
+    if args['std_stack_file']:
+        stacks.append('std')
+        stack_fnames.append(args['std_stack_file'])
+        stack_kwargs.append(None)
+        LOGGER.debug("Added standard deviation stack")
+    if args['var_stack_file']:
+        stacks.append('var')
+        stack_fnames.append(args['var_stack_file'])
+        stack_kwargs.append(None)
+        LOGGER.debug("Added variance stack")
     if args['median_stack_file']:
         stacks.append('median')
         stack_fnames.append(args['median_stack_file'])
-        stack_kwargs.append(None)
+        stack_kwargs.append(dict(deep_kwargs))
         LOGGER.debug("Added median stack")
+    if args['approx_median_stack_file']:
+        stacks.append('approx_median')
+        stack_fnames.append(args['approx_median_stack_file'])
+        if isinstance(args['median_bins'], int):
+            stack_kwargs.append({'bins': args['median_bins']})
+        else:
+            stack_kwargs.append(None)
+        LOGGER.debug("Added approximate median stack")
     if args['sigma_stack_file']:
         stacks.append('sigma')
         stack_fnames.append(args['sigma_stack_file'])
+        kwargs = dict(deep_kwargs)
         if args['kappa_sigma_params']:
             tmp = args['kappa_sigma_params'].split(',')
-            stack_kwargs.append({'kappa': float(tmp[0]),
-                                 'max_iters': int(tmp[1])})
-        else:
-            stack_kwargs.append(None)
+            kwargs['kappa'] = float(tmp[0])
+            kwargs['max_iters'] = int(tmp[1])
+        stack_kwargs.append(kwargs)
         LOGGER.debug("Added median stack")
     args['stacks'] = stacks
     args['stack_fnames'] = stack_fnames
@@ -321,7 +507,8 @@ def main():
 
     LOGGER.info("Starting stacking")
 
-    halostack_cli(args)
+    with worker_pool(args['nprocs']):
+        halostack_cli(args)
 
 
 if __name__ == "__main__":
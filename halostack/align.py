@@ -24,10 +24,35 @@
 
 import numpy as np
 import logging
-from multiprocessing import Pool
+import hashlib
+import json
+import os
+import tempfile
+from halostack.pool import get_pool, SharedArray, attach
+from halostack.helpers import bilinear_sample, warp, WARP_BLOCK_ROWS
 
 LOGGER = logging.getLogger(__name__)
 
+# Maximum number of downscaling levels used in pyramid search, each
+# level halving the image size
+PYRAMID_LEVELS = 3
+# Smallest reference radius, in pixels, allowed on the coarsest level
+PYRAMID_MIN_RADIUS = 2
+# Half-width of the refinement window, in pixels, on each finer level
+PYRAMID_REFINE = 2
+
+# Number of angles and radii in the log-polar reference spectrum used
+# for estimating image rotation
+ROTATION_ANGLES = 180
+ROTATION_RADII = 32
+# Initial step, in degrees, and number of iterations for refining the
+# rotation angle
+ROTATION_STEP = 1.
+ROTATION_ITERATIONS = 8
+# Half-width of the window, in pixels, for refining the location of
+# the rotated reference
+ROTATION_REFINE = 5
+
 class Align(object):
     '''Class to coalign images
 
@@ -43,38 +68,57 @@ class Align(object):
     :type mode: str
     :param nprocs: number or parallel processes used for finding best fit
     :type nprocs: int
+    :param subpixel: refine the match to sub-pixel accuracy
+    :type subpixel: bool
+    :param cache: cache for the alignment results
+    :type cache: halostack.align.AlignCache or None
 
     Available alignment methods are::
 
-    'simple'
+    'simple' - least squares difference search
+    'fft' - least squares difference search of the whole search area
+            using one FFT correlation
+    'pyramid' - coarse-to-fine least squares difference search
+    'rotation' - least squares difference search and log-polar
+                 rotation estimate
     '''
 
-    def __init__(self, img, cor_th=70.0, mode='simple', nprocs=1):
+    def __init__(self, img, cor_th=70.0, mode='simple', nprocs=1,
+                 subpixel=False, cache=None):
 
         LOGGER.debug("Initiliazing aligner using %s mode.", mode)
-        modes = {'simple': self._simple_match}
+        modes = {'simple': self._simple_match,
+                 'fft': self._fft_match,
+                 'pyramid': self._pyramid_match,
+                 'rotation': self._rotation_match}
 
         self.img = img
         self._img_shape = list(self.img.shape)
         self.correlation_threshold = cor_th
         self._nprocs = nprocs
+        self.subpixel = subpixel
+        self._shift_buffers = None
+        self._warp_buffers = None
+        self.angle = 0.
+        self.correlation = None
+        self.cache = cache
 
         self.ref_loc = None
         self.srch_area = None
         self.ref = None
+        self._ref_fft = None
+        self._ref_pyramid = []
+        self._ref_polar = None
+        self._ref_sqsums = []
+        self._shared_refs = []
 
-        if self._nprocs > 1:
-            self._pool = Pool(self._nprocs)
-        else:
-            self._pool = None
-
-        try:
-            self.align_func = modes[mode]
-        except AttributeError:
+        if mode not in modes:
             LOGGER.warning("Alignment mode %s not recognized, "
                            "using simple mode instead.",
                            mode)
-            self.align_func = self._simple_match
+            mode = 'simple'
+        self.mode = mode
+        self.align_func = modes[mode]
 
         # default to search from the whole image
         y_size, x_size = self._img_shape[:2]
@@ -92,8 +136,21 @@ class Align(object):
                      area[0], area[1], area[2])
         self.ref_loc = area
         self._set_ref()
+        self._set_ref_fft()
+        self._set_ref_pyramid()
+        self._share_refs()
+        if self.mode == 'rotation':
+            self._ref_polar = _polar_spectrum(self.ref)
         self.img = None
 
+    def close(self):
+        '''Release the reference data shared with the worker
+        processes.
+        '''
+        for shared in self._shared_refs:
+            shared.close()
+        self._shared_refs = []
+
     def set_search_area(self, area):
         '''Set the reference search area *area*.
 
@@ -103,6 +160,7 @@ class Align(object):
         LOGGER.debug("Setting search area to center: (%d, %d), radius: %d.",
                      area[0], area[1], area[2])
         self.srch_area = area
+        self._set_ref_fft()
 
 
     def align(self, img):
@@ -111,24 +169,64 @@ class Align(object):
         :param img: image to align with the reference
         :type img: halostack.image.Image
         '''
-        LOGGER.info("Calculating image alignment.")
-        # Get the correlation and the location of the best match
-        corr, x_loc, y_loc = self.align_func(img)
+        key = None
+        result = None
+        if self.cache is not None:
+            key = self.cache.key(img, self._cache_settings())
+            result = self.cache.get(key)
+        if result is None:
+            LOGGER.info("Calculating image alignment.")
+            result = self._calc_alignment(img)
+            if self.cache is not None:
+                self.cache.put(key, result)
+        else:
+            LOGGER.info("Using cached image alignment.")
+
+        corr, x_loc, y_loc = result['correlation'], result['x'], result['y']
+        self.correlation = corr
+        self.angle = result['angle']
         if corr < self.correlation_threshold:
             LOGGER.warning("Correlation (%.3f) lower than the given " + \
                                "threshold (%.3f).",
                            corr, self.correlation_threshold)
             return None
         LOGGER.info("Match found, correlation: %.3lf.", corr)
+        if self.mode == 'rotation':
+            LOGGER.debug("Rotating image: %.2f degrees.",
+                         np.degrees(self.angle))
+            return self._warp(img, x_loc, y_loc, self.angle)
         # Calculate shift
         x_shift, y_shift = self._calc_shift(x_loc, y_loc)
-        LOGGER.debug("Shifting image: x = %d, y = %d.",
+        LOGGER.debug("Shifting image: x = %.2f, y = %.2f.",
                     x_shift, y_shift)
         # Shift the image
         img = self._shift(img, x_shift, y_shift)
 
         return img
 
+    def _calc_alignment(self, img):
+        '''Find the best match of the reference in the image.  Returns
+        a dictionary with the correlation, the location and the
+        rotation angle of the match.
+        '''
+        # Get the correlation and the location of the best match
+        corr, x_loc, y_loc = self.align_func(img)
+        if self.mode != 'rotation':
+            self.angle = 0.
+            if self.subpixel:
+                x_loc, y_loc = self._refine_location(img, x_loc, y_loc)
+
+        return {'correlation': _to_number(corr), 'x': _to_number(x_loc),
+                'y': _to_number(y_loc), 'angle': _to_number(self.angle)}
+
+    def _cache_settings(self):
+        '''Return a string identifying the alignment settings and the
+        reference for the alignment cache.
+        '''
+        digest = hashlib.sha1(np.ascontiguousarray(self.ref))
+        return repr((digest.hexdigest(), list(self.ref_loc),
+                     list(self.srch_area), self.mode, self.subpixel))
+
 
     def _set_ref(self):
         '''Set reference values.
@@ -138,6 +236,62 @@ class Align(object):
                             self.ref_loc[0]-self.ref_loc[2]:\
                                 self.ref_loc[0]+self.ref_loc[2] + 1].copy()
 
+    def _set_ref_fft(self):
+        '''Calculate and cache the complex conjugate of the reference
+        spectrum used in FFT matching.  The spectrum size depends on
+        the search area, so this needs to be redone if either the
+        reference or the search area changes.
+        '''
+        if self.ref is None or self.mode != 'fft':
+            return
+        ref_shp = [i//2 for i in self.ref.shape]
+        xlims, ylims = self._calc_search_limits(self._img_shape, ref_shp)
+        shape = (ylims[1] - ylims[0] + 2*ref_shp[0],
+                 xlims[1] - xlims[0] + 2*ref_shp[1])
+        LOGGER.debug("Calculating reference spectrum of size %dx%d.",
+                     shape[1], shape[0])
+        ref = np.asarray(self.ref, dtype=np.float64)
+        if ref.ndim == 2:
+            ref = ref[:, :, np.newaxis]
+        self._ref_fft = np.conj(np.fft.rfft2(ref, s=shape, axes=(0, 1)))
+
+    def _set_ref_pyramid(self):
+        '''Calculate downscaled reference luminances used in pyramid
+        search.  The coarsest level is first limited by
+        PYRAMID_LEVELS, and by PYRAMID_MIN_RADIUS for the reference
+        size.
+        '''
+        self._ref_pyramid = []
+        if self.mode != 'pyramid':
+            return
+        radius = self.ref_loc[2]
+        data = self.img[...]
+        for level in range(1, PYRAMID_LEVELS + 1):
+            radius //= 2
+            x_c, y_c = self.ref_loc[0] >> level, self.ref_loc[1] >> level
+            if radius < PYRAMID_MIN_RADIUS or \
+                    x_c < radius or y_c < radius:
+                break
+            data = _downscale(data)
+            ref = data[y_c-radius:y_c+radius+1, x_c-radius:x_c+radius+1]
+            if ref.shape != (2*radius+1, 2*radius+1):
+                break
+            self._ref_pyramid.append(ref.copy())
+        LOGGER.debug("Using %d pyramid level(s).", len(self._ref_pyramid))
+
+    def _share_refs(self):
+        '''Calculate the sum of squares of the reference on each
+        pyramid level, and copy the references to shared arrays for
+        the worker processes.  This is done once for each reference
+        instead of for every searched image.
+        '''
+        self.close()
+        refs = [self.ref] + self._ref_pyramid
+        self._ref_sqsums = [np.sum(np.asarray(ref, dtype=np.float64)**2)
+                            for ref in refs]
+        if self._nprocs > 1:
+            self._shared_refs = [SharedArray(ref) for ref in refs]
+
     def _find_reference(self, img):
         '''Find the reference area from the given image.
         '''
@@ -146,41 +300,226 @@ class Align(object):
 
 
     def _fft_match(self, img):
-        '''Use FFT to find the best alignment.
+        '''Use least squared difference to find the best alignment.
+        The differences for the whole search area are calculated with
+        one FFT correlation using the cached reference spectrum.
         '''
-        del img
-        LOGGER.error("TODO: FFT alignment not implemented.")
+        ref_shp = [i//2 for i in self.ref.shape]
+        xlims, ylims = self._calc_search_limits(self._img_shape, ref_shp)
+
+        LOGGER.debug("Search area is in x: %d-%d, in y: %d-%d",
+                     xlims[0], xlims[1],
+                     ylims[0], ylims[1])
 
+        if self._ref_fft is None:
+            self._set_ref_fft()
 
-    def _parallel_search(self, img, xlims, ylims, ref_shp):
-        '''Search for the best match in parallel.
+        data = img[ylims[0]-ref_shp[0]:ylims[1]+ref_shp[0],
+                   xlims[0]-ref_shp[1]:xlims[1]+ref_shp[1]]
+        ref_fft = self._ref_fft
+        if ref_fft.shape[:2] != (data.shape[0], data.shape[1]//2 + 1):
+            ref_fft = None
+        sqdiffs = _sqdiff_map(data, self.ref, self._ref_sqsums[0], ref_fft)
+        y_idx, x_idx = np.unravel_index(np.argmin(sqdiffs), sqdiffs.shape)
+        x_loc, y_loc = x_idx + xlims[0], y_idx + ylims[0]
+
+        return (self._calc_correlation(img, x_loc, y_loc),
+                x_loc, y_loc) # corr, x, y
+
+
+    def _parallel_search(self, img, xlims, ylims, level=0):
+        '''Search for the best match of the reference of pyramid
+        *level* in parallel.  The search area is split to vertical
+        strips, one for each process.
         '''
+        if level == 0:
+            ref = self.ref
+        else:
+            ref = self._ref_pyramid[level-1]
+        ref_sqsum = self._ref_sqsums[level]
+        ref_shp = [i//2 for i in ref.shape]
 
-        data = []
-        for i in range(xlims[0], xlims[1]):
-            xran = range(i-ref_shp[1], i+ref_shp[1]+1)
-            data.append((img[:, xran], ylims, self.ref))
+        num_strips = max(1, min(self._nprocs, xlims[1] - xlims[0]))
+        x_starts = np.linspace(xlims[0], xlims[1],
+                               num_strips+1).astype(np.int64)
+        window = img[ylims[0]-ref_shp[0]:ylims[1]+ref_shp[0],
+                     x_starts[0]-ref_shp[1]:x_starts[-1]+ref_shp[1]]
+        x_rel = x_starts - x_starts[0]
 
         if self._nprocs > 1:
-            result = self._pool.map(_simple_search_worker, data)
+            # Workers attach to the shared search window and reference
+            # and get only the column range of their strip
+            with SharedArray(window) as shared_img:
+                data = [(shared_img.spec(), self._shared_refs[level].spec(),
+                         ref_sqsum, x_rel[i], x_rel[i+1] + 2*ref_shp[1])
+                        for i in range(num_strips)]
+                result = get_pool(self._nprocs).map(_simple_search_worker,
+                                                    data)
         else:
-            result = map(_simple_search_worker, data)
+            result = [_search_strip(window[:, x_rel[i]:
+                                               x_rel[i+1] + 2*ref_shp[1]],
+                                    ref, ref_sqsum)
+                      for i in range(num_strips)]
 
-        result = np.array(result)
+        result = np.array(list(result))
         idx = np.argmin(result[:, 0])
 
-        return [result[idx, 0], idx+xlims[0], int(result[idx, 1])]
+        return [result[idx, 0], int(result[idx, 1]) + x_starts[idx],
+                int(result[idx, 2]) + ylims[0]]
 
 
     def _simple_match(self, img):
         '''Use least squared difference to find the best alignment. Slow.
         '''
         # Image and reference sizes
-        img_shp = list(img.shape)
+        img_shp = self._img_shape
         # loop is from {x,y} - ref_{x,y} to {x,y} + ref_{x,y} so
         # divide reference dimensions by two
         ref_shp = [i/2 for i in self.ref.shape]
 
+        xlims, ylims = self._calc_search_limits(img_shp, ref_shp)
+
+        LOGGER.debug("Search area is in x: %d-%d, in y: %d-%d",
+                     xlims[0], xlims[1],
+                     ylims[0], ylims[1])
+
+        LOGGER.debug("Searching for best match using %d thread(s).",
+                     self._nprocs)
+        best_res = self._parallel_search(img, xlims, ylims)
+
+        return (self._calc_correlation(img, best_res[1], best_res[2]),
+                best_res[1], best_res[2]) # corr, x, y
+
+    def _pyramid_match(self, img):
+        '''Use least squared difference to find the best alignment
+        first from downscaled images, and refine the location on each
+        finer level within a small window.
+        '''
+        if len(self._ref_pyramid) == 0:
+            LOGGER.debug("Reference too small for pyramid search.")
+            return self._simple_match(img)
+
+        img_shp = self._img_shape
+        ref_shp = [i//2 for i in self.ref.shape]
+        xlims, ylims = self._calc_search_limits(img_shp, ref_shp)
+
+        LOGGER.debug("Search area is in x: %d-%d, in y: %d-%d",
+                     xlims[0], xlims[1],
+                     ylims[0], ylims[1])
+
+        # Crop the search area so that it's aligned with the grid of
+        # the coarsest level
+        levels = len(self._ref_pyramid)
+        factor = 2**levels
+        x_0 = (xlims[0] - ref_shp[1]) // factor * factor
+        y_0 = (ylims[0] - ref_shp[0]) // factor * factor
+        x_1 = min(xlims[1] + ref_shp[1] + factor, img_shp[1])
+        y_1 = min(ylims[1] + ref_shp[0] + factor, img_shp[0])
+
+        pyramid = [img[y_0:y_1, x_0:x_1]]
+        for level in range(levels):
+            pyramid.append(_downscale(pyramid[-1]))
+
+        def _level_limits(lims, offset, level, radius, size):
+            '''Search limits on the given level, relative to the
+            cropped area.
+            '''
+            return [max((lims[0] - offset) >> level, radius),
+                    min(((lims[1] - offset) >> level) + 1, size - radius)]
+
+        # Full search on the coarsest level
+        ref = self._ref_pyramid[-1]
+        radius = ref.shape[0] // 2
+        xlims_lvl = _level_limits(xlims, x_0, levels, radius,
+                                  pyramid[-1].shape[1])
+        ylims_lvl = _level_limits(ylims, y_0, levels, radius,
+                                  pyramid[-1].shape[0])
+        LOGGER.debug("Searching for best match on level %d.", levels)
+        best_res = self._parallel_search(pyramid[-1], xlims_lvl, ylims_lvl,
+                                         levels)
+
+        # Refine on the finer levels
+        for level in range(levels-1, -1, -1):
+            if level > 0:
+                ref = self._ref_pyramid[level-1]
+            else:
+                ref = self.ref
+            radius = ref.shape[0] // 2
+            xlims_lvl = _level_limits(xlims, x_0, level, radius,
+                                      pyramid[level].shape[1])
+            ylims_lvl = _level_limits(ylims, y_0, level, radius,
+                                      pyramid[level].shape[0])
+            xlims_lvl = [max(2*best_res[1] - PYRAMID_REFINE, xlims_lvl[0]),
+                         min(2*best_res[1] + PYRAMID_REFINE + 2,
+                             xlims_lvl[1])]
+            ylims_lvl = [max(2*best_res[2] - PYRAMID_REFINE, ylims_lvl[0]),
+                         min(2*best_res[2] + PYRAMID_REFINE + 2,
+                             ylims_lvl[1])]
+            if xlims_lvl[0] >= xlims_lvl[1] or \
+                    ylims_lvl[0] >= ylims_lvl[1]:
+                LOGGER.warning("Pyramid search left the search area.")
+                return self._simple_match(img)
+            LOGGER.debug("Refining best match on level %d.", level)
+            best_res = self._parallel_search(pyramid[level], xlims_lvl,
+                                             ylims_lvl, level)
+
+        x_loc, y_loc = best_res[1] + x_0, best_res[2] + y_0
+
+        return (self._calc_correlation(img, x_loc, y_loc),
+                x_loc, y_loc) # corr, x, y
+
+    def _rotation_match(self, img):
+        '''Use least squared difference to find the reference
+        location, and log-polar magnitude spectra to find the image
+        rotation.  Both are then refined using least squared
+        difference.  The rotation angle is stored to *self.angle*.
+        '''
+        corr, x_loc, y_loc = self._simple_match(img)
+
+        ref_shp = [i//2 for i in self.ref.shape]
+        if x_loc - ref_shp[1] < 0 or y_loc - ref_shp[0] < 0:
+            self.angle = 0.
+            return corr, x_loc, y_loc
+        patch = img[y_loc-ref_shp[0]:y_loc+ref_shp[0]+1,
+                    x_loc-ref_shp[1]:x_loc+ref_shp[1]+1]
+        angle = _estimate_rotation(self._ref_polar, _polar_spectrum(patch))
+        LOGGER.debug("Initial rotation estimate: %.2f degrees.",
+                     np.degrees(angle))
+
+        # Use luminance from a crop that contains the rotated reference
+        # area also after the refinement
+        ref = np.asarray(self.ref, dtype=np.float64)
+        if ref.ndim == 3:
+            ref = np.mean(ref, 2)
+        radius = int(np.ceil(np.sqrt(2) * (max(ref_shp) + 2*ROTATION_REFINE)))
+        x_0, y_0 = max(x_loc - radius, 0), max(y_loc - radius, 0)
+        crop = np.asarray(img[y_0:y_loc+radius+1, x_0:x_loc+radius+1],
+                          dtype=np.float64)
+        if crop.ndim == 3:
+            crop = np.mean(crop, 2)
+        x_loc, y_loc = float(x_loc - x_0), float(y_loc - y_0)
+
+        for _ in range(2):
+            x_loc, y_loc = _refine_rotated_location(crop, ref, x_loc, y_loc,
+                                                    angle)
+            angle = _refine_angle(crop, ref, x_loc, y_loc, angle)
+        x_loc, y_loc = _refine_rotated_location(crop, ref, x_loc, y_loc, angle)
+        x_loc, y_loc = x_loc + x_0, y_loc + y_0
+        self.angle = angle
+
+        # Correlation between the reference and the rotated image
+        y_c, x_c = _rotated_grid(ref_shp, x_loc, y_loc, angle)
+        data = img[...]
+        best_fit_data = np.empty(self.ref.shape, dtype=np.float64)
+        bilinear_sample(data, y_c, x_c, best_fit_data)
+        corr = np.corrcoef(best_fit_data.flatten(), self.ref.flatten())**2
+
+        return (corr[0, 1], x_loc, y_loc) # corr, x, y
+
+    def _calc_search_limits(self, img_shp, ref_shp):
+        '''Calculate the limits for the reference center location
+        within the search area.
+        '''
         xlims = [self.srch_area[0]-self.srch_area[2],
                  self.srch_area[0]+self.srch_area[2]]
         ylims = [self.srch_area[1]-self.srch_area[2],
@@ -198,23 +537,61 @@ class Align(object):
         if ylims[1] >= img_shp[0] - ref_shp[0]:
             ylims[1] = img_shp[0] - ref_shp[0] - 1
 
-        LOGGER.debug("Search area is in x: %d-%d, in y: %d-%d",
-                     xlims[0], xlims[1],
-                     ylims[0], ylims[1])
+        return xlims, ylims
 
-        LOGGER.debug("Searching for best match using %d thread(s).",
-                     self._nprocs)
-        best_res = self._parallel_search(img, xlims, ylims, ref_shp)
-
-        # Calculate correlation coeff for the best fit
-        best_fit_data = img[best_res[2]-ref_shp[0]:best_res[2]+ref_shp[0]+1,
-                            best_res[1]-ref_shp[1]:best_res[1]+ref_shp[1]+1]
+    def _calc_correlation(self, img, x_loc, y_loc):
+        '''Calculate squared correlation coefficient between the
+        reference and the image area centered at (*x_loc*, *y_loc*).
+        '''
+        ref_shp = [i//2 for i in self.ref.shape]
+        best_fit_data = img[y_loc-ref_shp[0]:y_loc+ref_shp[0]+1,
+                            x_loc-ref_shp[1]:x_loc+ref_shp[1]+1]
         best_fit_data = best_fit_data.flatten()
         ref_flat = self.ref.flatten()
         best_corr = np.corrcoef(best_fit_data, ref_flat)**2
 
-        return (best_corr[0, 1], best_res[1], best_res[2]) # corr, x, y
+        return best_corr[0, 1]
+
 
+    def _refine_location(self, img, x_loc, y_loc):
+        '''Refine the location of the best match to sub-pixel accuracy
+        by fitting parabolas to the squared differences around it.
+        '''
+        ref_shp = [i//2 for i in self.ref.shape]
+        if x_loc - ref_shp[1] < 1 or y_loc - ref_shp[0] < 1 or \
+                x_loc + ref_shp[1] + 2 > self._img_shape[1] or \
+                y_loc + ref_shp[0] + 2 > self._img_shape[0]:
+            LOGGER.debug("Match too close to image edge for sub-pixel "
+                         "refinement.")
+            return x_loc, y_loc
+
+        sqdiffs = _sqdiff_map(img[y_loc-ref_shp[0]-1:y_loc+ref_shp[0]+2,
+                                  x_loc-ref_shp[1]-1:x_loc+ref_shp[1]+2],
+                              self.ref)
+
+        x_loc += _parabola_peak(*sqdiffs[1, :])
+        y_loc += _parabola_peak(*sqdiffs[:, 1])
+        LOGGER.debug("Sub-pixel location: x = %.2f, y = %.2f.",
+                     x_loc, y_loc)
+
+        return x_loc, y_loc
+
+    def _warp(self, img, x_loc, y_loc, angle):
+        '''Rotate the image by *angle* radians around the found
+        location (*x_loc*, *y_loc*), and move the location to the
+        reference location.
+        '''
+        LOGGER.debug("Warping image.")
+        new_img = 0*img
+        out = new_img[...]
+        if self._warp_buffers is None or \
+                self._warp_buffers[0].shape[1] != out.shape[1]:
+            self._warp_buffers = (np.empty((WARP_BLOCK_ROWS, out.shape[1])),
+                                  np.empty((WARP_BLOCK_ROWS, out.shape[1])))
+        warp(img[...], out, (x_loc, y_loc), self.ref_loc[:2], angle,
+             buffers=self._warp_buffers)
+
+        return new_img
 
     def _calc_shift(self, x_loc, y_loc):
         '''Calculate how much the images need to be shifted.
@@ -224,17 +601,28 @@ class Align(object):
 
 
     def _shift(self, img, x_shift, y_shift):
-        '''Shift the image by x_shift and y_shift pixels.
+        '''Shift the image by x_shift and y_shift pixels.  Fractional
+        shifts are applied using linear interpolation.
         '''
         LOGGER.debug("Shifting image.")
         new_img = 0*img
+        x_int, y_int = int(np.floor(x_shift)), int(np.floor(y_shift))
         output_x_range, output_y_range, input_x_range, input_y_range = \
-            self._calc_shift_ranges(x_shift, y_shift)
+            self._calc_shift_ranges(x_int, y_int)
         new_img[output_y_range[0]:output_y_range[1],
                 output_x_range[0]:output_x_range[1], :] = \
                 img[input_y_range[0]:input_y_range[1],
                     input_x_range[0]:input_x_range[1], :]
 
+        if x_shift != x_int or y_shift != y_int:
+            data = new_img[...]
+            if self._shift_buffers is None or \
+                    self._shift_buffers[0].shape != data.shape:
+                self._shift_buffers = (np.empty(data.shape, dtype=np.float64),
+                                       np.empty(data.shape, dtype=np.float64))
+            _linear_shift(data, x_shift - x_int, y_shift - y_int,
+                          self._shift_buffers)
+
         return new_img
 
 
@@ -268,28 +656,375 @@ class Align(object):
                 input_ranges[0], input_ranges[1])
 
 
-def _simple_search_worker(data_in):
-    '''Worker function for alignment search.
+def select_reference(img, radius, area=None):
+    '''Select the alignment reference automatically.  The reference
+    is the area having the highest variance of luminance.
+
+    :param img: image where the reference is selected
+    :type img: halostack.image.Image or Numpy array
+    :param radius: radius of the reference area
+    :type radius: int
+    :param area: area (x, y, radius) where the reference center is
+                 selected from [whole image]
+    :type area: 3-tuple or None
+    :rtype: list of the form [x, y, radius]
+    :raises ValueError: if no reference area fits in the image within
+                        *area*
+    '''
+    data = img[...]
+    if data.ndim > 2:
+        data = np.mean(data, 2)
+    data = data.astype(np.float64)
+
+    size = 2*radius + 1
+    sums = _window_sums(data, (size, size))
+    variance = _window_sums(data**2, (size, size))
+    sums /= size**2
+    variance /= size**2
+    variance -= sums**2
+    # Element [i, j] of variance is for the window centered at
+    # [i+radius, j+radius]
+    valid = np.zeros(variance.shape, dtype=bool)
+    if area is None:
+        valid[...] = True
+    else:
+        ylims = [max(0, area[1] - area[2] - radius),
+                 max(0, area[1] + area[2] - radius + 1)]
+        xlims = [max(0, area[0] - area[2] - radius),
+                 max(0, area[0] + area[2] - radius + 1)]
+        valid[ylims[0]:ylims[1], xlims[0]:xlims[1]] = True
+    if not np.any(valid):
+        raise ValueError("No reference area of radius %d fits in the "
+                         "image within the search area." % radius)
+    variance[~valid] = -1
+
+    y_idx, x_idx = np.unravel_index(np.argmax(variance), variance.shape)
+    LOGGER.info("Selected reference area: (%d, %d) with radius %d.",
+                x_idx + radius, y_idx + radius, radius)
+
+    return [int(x_idx + radius), int(y_idx + radius), radius]
+
+class AlignCache(object):
+    '''Alignment results stored in a JSON file.  The results are keyed
+    by a hash of the image data and of the alignment settings, so the
+    cached results are used only for the same images aligned the same
+    way.
+
+    :param fname: cache filename
+    :type fname: str
     '''
 
-    def _sum_of_squares(data):
-        '''Calculate sum of squares.
+    def __init__(self, fname):
+        self.fname = fname
+        self._results = {}
+        self._modified = False
+        if os.path.exists(fname):
+            try:
+                with open(fname) as fid:
+                    self._results = json.load(fid)
+                LOGGER.debug("Read %d alignments from %s.",
+                             len(self._results), fname)
+            except ValueError:
+                LOGGER.warning("Invalid alignment cache %s, ignoring.",
+                               fname)
+
+    @staticmethod
+    def key(img, settings):
+        '''Return cache key for image *img* aligned with *settings*.
+
+        :param img: image to align
+        :type img: halostack.image.Image
+        :param settings: alignment settings
+        :type settings: str
+        :rtype: str
+        '''
+        data = np.ascontiguousarray(img[...])
+        digest = hashlib.sha1(repr((data.shape, data.dtype.str,
+                                   settings)).encode('utf-8'))
+        digest.update(data)
+
+        return digest.hexdigest()
 
-        :param data: array of values
-        :type data: Numpy array
-        :rtype: float
+    def get(self, key):
+        '''Return the cached result for *key*, or None.
+
+        :rtype: dict or None
         '''
-        return (data**2).sum()
+        return self._results.get(key)
+
+    def put(self, key, result):
+        '''Store alignment result.
+
+        :param key: cache key
+        :type key: str
+        :param result: alignment result
+        :type result: dict
+        '''
+        self._results[key] = result
+        self._modified = True
+
+    def save(self):
+        '''Write the cache file, if there are new results.
+        '''
+        if not self._modified:
+            return
+        dirname = os.path.dirname(os.path.abspath(self.fname))
+        fid, tmp_fname = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        with os.fdopen(fid, 'w') as fid:
+            json.dump(self._results, fid)
+        os.rename(tmp_fname, self.fname)
+        self._modified = False
+        LOGGER.debug("Saved %d alignments to %s.", len(self._results),
+                     self.fname)
+
+def _to_number(val):
+    '''Convert a Numpy number to int or float that can be stored as
+    JSON.
+    '''
+    val = float(val)
+    if val.is_integer():
+        return int(val)
+    return val
+
+def _fft_data(data):
+    '''Convert *data* to zero-mean 2D luminance array for FFT matching.
+    '''
+    data = np.asarray(data, dtype=np.float64)
+    if data.ndim == 3:
+        data = np.mean(data, 2)
+
+    return data - np.mean(data)
+
+def _downscale(data):
+    '''Downscale *data* to half size using 2x2 block averages.  Color
+    images are converted to luminance.
+    '''
+    data = np.asarray(data, dtype=np.float64)
+    if data.ndim == 3:
+        data = np.mean(data, 2)
+    height, width = data.shape[0] // 2 * 2, data.shape[1] // 2 * 2
+    data = data[:height, :width]
+
+    return (data[0::2, 0::2] + data[1::2, 0::2] +
+            data[0::2, 1::2] + data[1::2, 1::2]) / 4.
+
+def _window_sums(data, shape):
+    '''Calculate sums of *data* within all the windows of size
+    *shape* that fit completely inside *data* using an integral
+    image.
+
+    :param data: 2D array of values
+    :type data: Numpy array
+    :param shape: window height and width
+    :type shape: 2-tuple
+    :rtype: Numpy array
+    '''
+    height, width = shape
+    integral = np.zeros((data.shape[0]+1, data.shape[1]+1),
+                        dtype=np.float64)
+    np.cumsum(data, 0, out=integral[1:, 1:])
+    np.cumsum(integral[1:, 1:], 1, out=integral[1:, 1:])
+
+    return (integral[height:, width:] - integral[:-height, width:] -
+            integral[height:, :-width] + integral[:-height, :-width])
+
+def _rotated_grid(radii, x_loc, y_loc, angle):
+    '''Calculate image coordinates for an area of size 2 * *radii* + 1
+    centered at (*x_loc*, *y_loc*) and rotated by *angle* radians.
+    '''
+    y_rel, x_rel = np.mgrid[-radii[0]:radii[0]+1,
+                            -radii[1]:radii[1]+1].astype(np.float64)
+    cos, sin = np.cos(angle), np.sin(angle)
+
+    return (sin * x_rel + cos * y_rel + y_loc,
+            cos * x_rel - sin * y_rel + x_loc)
+
+def _rotated_sqdiff(data, ref, x_loc, y_loc, angle):
+    '''Sum of squared differences between *ref* and the rotated area
+    of *data* centered at (*x_loc*, *y_loc*).
+    '''
+    y_c, x_c = _rotated_grid([i//2 for i in ref.shape], x_loc, y_loc, angle)
+    patch = np.empty(ref.shape, dtype=np.float64)
+    bilinear_sample(data, y_c, x_c, patch)
+
+    return np.sum((patch - ref)**2)
+
+def _parabola_peak(left, center, right):
+    '''Location of the minimum of a parabola fitted to three equally
+    spaced values, limited to half a step from the center.
+    '''
+    denom = left - 2*center + right
+    if denom <= 0:
+        return 0.
+    return min(max(0.5 * (left - right) / denom, -0.5), 0.5)
+
+def _refine_angle(data, ref, x_loc, y_loc, angle):
+    '''Refine the rotation *angle* by minimizing the squared
+    difference between *ref* and the rotated area of *data*.
+    '''
+    step = np.radians(ROTATION_STEP)
+    for _ in range(ROTATION_ITERATIONS):
+        sqdiffs = [_rotated_sqdiff(data, ref, x_loc, y_loc, angle + i*step)
+                   for i in (-1, 0, 1)]
+        if sqdiffs[0] < sqdiffs[1] and sqdiffs[0] <= sqdiffs[2]:
+            angle -= step
+        elif sqdiffs[2] < sqdiffs[1]:
+            angle += step
+        else:
+            angle += step * _parabola_peak(*sqdiffs)
+            step /= 4.
+
+    return angle
+
+def _refine_rotated_location(data, ref, x_loc, y_loc, angle):
+    '''Refine the location of the rotated reference area to sub-pixel
+    accuracy.
+    '''
+    radii = [i//2 + ROTATION_REFINE for i in ref.shape]
+    y_c, x_c = _rotated_grid(radii, x_loc, y_loc, angle)
+    area = np.empty(y_c.shape, dtype=np.float64)
+    bilinear_sample(data, y_c, x_c, area)
+    sqdiffs = _sqdiff_map(area, ref)
+
+    y_idx, x_idx = np.unravel_index(np.argmin(sqdiffs), sqdiffs.shape)
+    x_rel, y_rel = float(x_idx), float(y_idx)
+    if 0 < x_idx < sqdiffs.shape[1] - 1:
+        x_rel += _parabola_peak(*sqdiffs[y_idx, x_idx-1:x_idx+2])
+    if 0 < y_idx < sqdiffs.shape[0] - 1:
+        y_rel += _parabola_peak(*sqdiffs[y_idx-1:y_idx+2, x_idx])
+    x_rel -= ROTATION_REFINE
+    y_rel -= ROTATION_REFINE
+
+    cos, sin = np.cos(angle), np.sin(angle)
+
+    return (x_loc + cos * x_rel - sin * y_rel,
+            y_loc + sin * x_rel + cos * y_rel)
+
+def _polar_spectrum(data):
+    '''Calculate the magnitude spectrum of *data* sampled in log-polar
+    coordinates.  Rotation of the data is seen as a shift along the
+    angle axis.
+    '''
+    data = _fft_data(data)
+    data *= np.outer(np.hanning(data.shape[0]), np.hanning(data.shape[1]))
+    spectrum = np.log1p(np.abs(np.fft.fftshift(np.fft.fft2(data))))
+
+    y_c, x_c = spectrum.shape[0] // 2, spectrum.shape[1] // 2
+    radii = np.exp(np.linspace(0, np.log(min(y_c, x_c) - 1), ROTATION_RADII))
+    angles = np.linspace(0, np.pi, ROTATION_ANGLES, endpoint=False)
+    polar = np.empty((ROTATION_RADII, ROTATION_ANGLES), dtype=np.float64)
+    bilinear_sample(spectrum,
+                     y_c + radii[:, np.newaxis] * np.sin(angles),
+                     x_c + radii[:, np.newaxis] * np.cos(angles),
+                     polar)
+
+    return polar - np.mean(polar, 1)[:, np.newaxis]
+
+def _estimate_rotation(ref_polar, polar):
+    '''Estimate rotation angle, in radians, between two log-polar
+    spectra using circular cross-correlation along the angle axis.
+    The result is between -pi/2 and pi/2.
+    '''
+    corr = np.fft.irfft(np.fft.rfft(polar, axis=1) *
+                        np.conj(np.fft.rfft(ref_polar, axis=1)),
+                        n=ROTATION_ANGLES, axis=1).sum(0)
+    idx = np.argmax(corr)
+    # Fit the parabola to the negated peak
+    idx += _parabola_peak(-corr[idx-1], -corr[idx],
+                          -corr[(idx+1) % ROTATION_ANGLES])
+    angle = idx * np.pi / ROTATION_ANGLES
+    if angle > np.pi / 2:
+        angle -= np.pi
+
+    return angle
+
+def _linear_shift(data, x_frac, y_frac, buffers):
+    '''Shift *data* in-place by sub-pixel amounts using separable
+    linear interpolation.  Edge rows and columns are replicated.
+
+    :param data: image data
+    :type data: Numpy array
+    :param x_frac: shift in x-direction, between 0 and 1
+    :type x_frac: float
+    :param y_frac: shift in y-direction, between 0 and 1
+    :type y_frac: float
+    :param buffers: two float arrays with the same shape as *data*
+    :type buffers: 2-tuple of Numpy arrays
+    '''
+    buf, diff = buffers
+    np.copyto(buf, data)
+
+    # out(x) = in(x) + frac * (in(x-1) - in(x))
+    diff[:, 0] = 0
+    np.subtract(buf[:, :-1], buf[:, 1:], out=diff[:, 1:])
+    diff *= x_frac
+    buf += diff
+
+    diff[0] = 0
+    np.subtract(buf[:-1], buf[1:], out=diff[1:])
+    diff *= y_frac
+    buf += diff
+
+    if data.dtype.kind in 'iu':
+        np.rint(buf, out=buf)
+    np.copyto(data, buf, casting='unsafe')
+
+def _sqdiff_map(data, ref, ref_sqsum=None, ref_fft=None):
+    '''Calculate the sum of squared differences for every reference
+    location within the data as ||a||^2 - 2a.b + ||b||^2, where the
+    window sums ||a||^2 come from an integral image and the cross
+    terms from FFT correlation.
+
+    :param data: image data
+    :type data: Numpy array
+    :param ref: reference data
+    :type ref: Numpy array
+    :param ref_sqsum: precalculated sum of squares of *ref*
+    :type ref_sqsum: float or None
+    :param ref_fft: precalculated complex conjugate of the (rows,
+                    columns, channels) reference spectrum of the data
+                    size
+    :type ref_fft: Numpy array or None
+    :rtype: Numpy array
+    '''
+
+    data = np.asarray(data, dtype=np.float64)
+    ref = np.asarray(ref, dtype=np.float64)
+    if data.ndim == 2:
+        data = data[:, :, np.newaxis]
+    if ref.ndim == 2:
+        ref = ref[:, :, np.newaxis]
+
+    shape = data.shape[:2]
+    out_shape = (shape[0] - ref.shape[0] + 1, shape[1] - ref.shape[1] + 1)
 
-    data = data_in[0]
-    lims = data_in[1]
-    ref = data_in[2]
+    if ref_fft is None:
+        ref_fft = np.conj(np.fft.rfft2(ref, s=shape, axes=(0, 1)))
+    cross = np.sum(np.fft.rfft2(data, axes=(0, 1)) * ref_fft, 2)
+    cross = np.fft.irfft2(cross, s=shape)[:out_shape[0], :out_shape[1]]
 
-    ref_shp = [i/2 for i in ref.shape]
-    sqdiffs = 2**64 * np.ones(lims[1])
-    for j in range(lims[0], lims[1]):
-        sqdiffs[j] = _sum_of_squares(data[j-ref_shp[0]:j+ref_shp[0]+1, :] - ref)
+    sqdiffs = _window_sums(np.sum(data**2, 2), ref.shape[:2])
+    sqdiffs -= 2 * cross
+    if ref_sqsum is None:
+        ref_sqsum = np.sum(ref**2)
+    sqdiffs += ref_sqsum
 
-    idx = np.argmin(sqdiffs)
+    return sqdiffs
+
+def _simple_search_worker(data_in):
+    '''Worker function for alignment search.  The input is (shared
+    image spec, shared reference spec, reference sum of squares, first
+    column, last column).
+    '''
+    data = attach(data_in[0], mode='r')[:, data_in[3]:data_in[4]]
+
+    return _search_strip(data, attach(data_in[1], mode='r'), data_in[2])
+
+def _search_strip(data, ref, ref_sqsum=None):
+    '''Return the minimum sum of squared differences and its location
+    relative to the first valid reference center location.
+    '''
+    sqdiffs = _sqdiff_map(data, ref, ref_sqsum)
+    y_idx, x_idx = np.unravel_index(np.argmin(sqdiffs), sqdiffs.shape)
 
-    return [sqdiffs[idx], idx]
+    return [sqdiffs[y_idx, x_idx], x_idx, y_idx]
@@ -24,15 +24,19 @@
 
 import logging
 from glob import glob
-import matplotlib.pyplot as plt
 import numpy as np
 import ConfigParser
 from collections import OrderedDict as od
+from collections import deque
+from multiprocessing.pool import ThreadPool
 import warnings
 import os.path
 
 LOGGER = logging.getLogger(__name__)
 
+# Number of image rows warped at a time
+WARP_BLOCK_ROWS = 128
+
 def get_filenames(fnames):
     '''Get filenames to a list. Expand wildcards etc.
 
@@ -89,6 +93,23 @@ def parse_enhancements(params):
 
     return output
 
+def parse_area(area):
+    '''Parse area given as string "x,y,radius".
+
+    :param area: area definition
+    :type area: str, list, tuple or None
+    :rtype: list of three ints, or None
+    '''
+    if area is None:
+        return None
+    if isinstance(area, str):
+        area = area.split(',')
+    area = [int(val) for val in area]
+    if len(area) != 3:
+        raise ValueError("Area needs to be given as x,y,radius")
+
+    return area
+
 def get_two_points(img_in):
     '''Get two image pixel coordinates from users' clicks on the
     image, and return them as 3-tuple:
@@ -115,6 +136,10 @@ def get_image_coordinates(img_in, num):
     :type num: int
     '''
 
+    # Import here, so that matplotlib is needed only when images are
+    # shown
+    import matplotlib.pyplot as plt
+
     # convert to numpy
     img_in.to_numpy()
 
@@ -199,3 +224,124 @@ def intermediate_fname(prefix, fname):
     fname = ''.join(parts)
 
     return os.path.join(dirname, fname)
+
+def prefetch(func, iterable, depth=2, threads=None):
+    '''Apply *func* to the items of *iterable* in background threads
+    and yield the results in the original order.  At most *depth*
+    items are processed ahead of the consumer, which limits the memory
+    use.  Exceptions raised by *func* are raised when the
+    corresponding result is reached.
+
+    :param func: function to apply
+    :type func: function
+    :param iterable: input items
+    :type iterable: iterable
+    :param depth: number of items processed ahead.  If zero, the items
+                  are processed when requested
+    :type depth: int
+    :param threads: number of threads [*depth*]
+    :type threads: int or None
+    :rtype: generator
+    '''
+    if depth < 1:
+        for item in iterable:
+            yield func(item)
+        return
+
+    pool = ThreadPool(threads or depth)
+    pending = deque()
+    try:
+        for item in iterable:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) > depth:
+                yield pending.popleft().get()
+        while len(pending) > 0:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def bilinear_sample(data, y_c, x_c, out):
+    '''Sample *data* at locations (*y_c*, *x_c*) using bilinear
+    interpolation, and write the result to *out*.  Locations outside
+    the data are set to zero.
+
+    :param data: image data
+    :type data: Numpy array
+    :param y_c: row coordinates
+    :type y_c: Numpy array
+    :param x_c: column coordinates
+    :type x_c: Numpy array
+    :param out: output array with shape y_c.shape + data.shape[2:]
+    :type out: Numpy array
+    '''
+    height, width = data.shape[:2]
+    valid = (y_c >= 0) & (y_c <= height - 1) & (x_c >= 0) & (x_c <= width - 1)
+    if height < 2 or width < 2:
+        # Interpolation needs two pixels in both directions, so repeat
+        # the edge pixels of too small data
+        pad = [(0, max(2 - height, 0)), (0, max(2 - width, 0))]
+        data = np.pad(data, pad + [(0, 0)] * (data.ndim - 2), mode='edge')
+        height, width = data.shape[:2]
+    y_0 = np.clip(np.floor(y_c), 0, height - 2)
+    x_0 = np.clip(np.floor(x_c), 0, width - 2)
+    y_f = y_c - y_0
+    x_f = x_c - x_0
+    idxs = (y_0 * width + x_0).astype(np.intp)
+    flat = data.reshape((height * width,) + data.shape[2:])
+    if data.ndim == 3:
+        y_f = y_f[..., np.newaxis]
+        x_f = x_f[..., np.newaxis]
+        valid = valid[..., np.newaxis]
+
+    result = flat[idxs] * (1 - x_f)
+    result += flat[idxs + 1] * x_f
+    result *= 1 - y_f
+    lower = flat[idxs + width] * (1 - x_f)
+    lower += flat[idxs + width + 1] * x_f
+    lower *= y_f
+    result += lower
+    result *= valid
+
+    if out.dtype.kind in 'iu':
+        np.rint(result, out=result)
+    np.copyto(out, result, casting='unsafe')
+
+def warp(data, out, src_loc, dst_loc, angle, buffers=None):
+    '''Rotate *data* by *angle* radians around *src_loc* and move
+    *src_loc* to *dst_loc*.  Positive angles rotate the image
+    counter-clockwise.  The result is written to *out* in blocks of
+    WARP_BLOCK_ROWS rows.
+
+    :param data: image data
+    :type data: Numpy array
+    :param out: output array of the same shape as *data*
+    :type out: Numpy array
+    :param src_loc: rotation center (x, y) in *data*
+    :type src_loc: 2-tuple
+    :param dst_loc: location (x, y) of the rotation center in *out*
+    :type dst_loc: 2-tuple
+    :param angle: rotation angle in radians
+    :type angle: float
+    :param buffers: two float arrays of shape (WARP_BLOCK_ROWS, width)
+                    for the coordinates
+    :type buffers: 2-tuple of Numpy arrays or None
+    '''
+    height, width = out.shape[:2]
+    if buffers is None:
+        buffers = (np.empty((WARP_BLOCK_ROWS, width)),
+                   np.empty((WARP_BLOCK_ROWS, width)))
+    y_c, x_c = buffers
+    x_rel = np.arange(width, dtype=np.float64) - dst_loc[0]
+    cos, sin = np.cos(angle), np.sin(angle)
+
+    for row in range(0, height, WARP_BLOCK_ROWS):
+        rows = min(WARP_BLOCK_ROWS, height - row)
+        y_rel = np.arange(row, row + rows, dtype=np.float64) - dst_loc[1]
+        # x_c = cos * x_rel - sin * y_rel + x_src
+        np.multiply(cos, x_rel, out=x_c[:rows])
+        x_c[:rows] += (src_loc[0] - sin * y_rel)[:, np.newaxis]
+        # y_c = sin * x_rel + cos * y_rel + y_src
+        np.multiply(sin, x_rel, out=y_c[:rows])
+        y_c[:rows] += (src_loc[1] + cos * y_rel)[:, np.newaxis]
+        bilinear_sample(data, y_c[:rows], x_c[:rows], out[row:row+rows])
@@ -27,10 +27,47 @@ from PythonMagick import Blob
 import numpy as np
 import itertools
 import logging
-from multiprocessing import Pool
+import struct
+import hashlib
+import os
+import tempfile
+import threading
+import zlib
+import Queue
+from halostack.pool import get_pool, SharedArray, attach
+from halostack.helpers import warp
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+try:
+    import rawpy
+except ImportError:
+    rawpy = None
 
 LOGGER = logging.getLogger(__name__)
 
+# Default zlib compression level for saved images
+COMPRESSION = 6
+# Number of rows filtered and compressed at a time when writing PNG
+# images
+PNG_BLOCK_ROWS = 32
+
+# Filename extensions of camera RAW formats
+RAW_EXTENSIONS = ('.cr2', '.crw', '.nef', '.nrw', '.arw', '.srf', '.sr2',
+                  '.orf', '.rw2', '.pef', '.raf', '.dng', '.3fr', '.erf',
+                  '.kdc', '.mrw', '.x3f')
+
+# Number of rows or columns blurred in one block
+BLUR_BLOCK_LINES = 256
+# Largest blur radius for which direct convolution is used instead of FFT
+BLUR_DIRECT_RADIUS = 8
+
 class Image(object):
     '''Class for handling images.
 
@@ -42,15 +79,16 @@ class Image(object):
     :type enhancements: dictionary or None
     :param nprocs: number or parallel processes
     :type nprocs: int
+    :param cache: cache for the decoded image data
+    :type cache: halostack.image.FrameCache or None
     '''
 
     def __init__(self, img=None, fname=None, enhancements=None,
-                 nprocs=1):
+                 nprocs=1, cache=None):
         self.img = img
         self.fname = fname
         self._nprocs = nprocs
-
-        self._pool = None
+        self._cache = cache
 
         if fname is not None:
             self._read()
@@ -157,10 +195,41 @@ class Image(object):
         self.img[idx] = val
 
     def _read(self):
-        '''Read the image.
+        '''Read the image.  The readers registered for the filename
+        extension are tried in order, and PythonMagick is used if none
+        of them can read the image.
         '''
         LOGGER.info("Reading image %s.", self.fname)
-        self.img = PMImage(self.fname)
+        if self._cache is not None:
+            self.img = self._cache.get(self.fname)
+            if self.img is not None:
+                return
+            self.img = self._decode()
+            self._to_numpy()
+            self._cache.put(self.fname, self.img)
+        else:
+            self.img = self._decode()
+
+    def _decode(self):
+        '''Decode the image file.
+        '''
+        ext = os.path.splitext(self.fname)[1].lower()
+        for extensions, reader in READERS:
+            if ext not in extensions:
+                continue
+            try:
+                img = reader(self.fname)
+            except Exception as err: # pylint: disable=broad-except
+                LOGGER.debug("Reader %s failed: %s", reader.__name__, err)
+                continue
+            if img is not None:
+                LOGGER.debug("Read using %s.", reader.__name__)
+                if img.ndim == 2:
+                    img = img[:, :, np.newaxis]
+                if not img.flags.writeable:
+                    img = img.copy()
+                return img
+        return PMImage(self.fname)
 
     def set_dtype(self, dtype):
         '''Set image data dtype.
@@ -183,6 +252,7 @@ class Image(object):
         '''
         if isinstance(self.img, PMImage):
             self.img = to_numpy(self.img)
+        if isinstance(self.img, np.ndarray):
             self.shape = self.img.shape
 
     def _to_imagemagick(self, bits=16):
@@ -190,8 +260,11 @@ class Image(object):
         '''
         self.img = to_imagemagick(self.img, bits=bits)
 
-    def save(self, fname, bits=16, enhancements=None):
-        '''Save the image data.
+    def save(self, fname, bits=16, enhancements=None,
+             compression=COMPRESSION):
+        '''Save the image data.  PNG images, and TIFF images if
+        tifffile is available, are written directly from the Numpy
+        data.  Other formats are written using PythonMagick.
 
         :param fname: output filename
         :type fname: str
@@ -199,13 +272,22 @@ class Image(object):
         :type bits: int
         :param enhancements: image processing applied to the image before saving
         :type enhancements: dictionary or None
+        :param compression: zlib compression level from 0 (none) to 9
+                            (best) for PNG and TIFF images
+        :type compression: int
         '''
 
         if enhancements:
             LOGGER.info("Postprocessing output image.")
             self.enhance(enhancements)
-        self._to_imagemagick(bits=bits)
         LOGGER.info("Saving %s.", fname)
+        ext = os.path.splitext(fname)[1].lower()
+        for extensions, writer in WRITERS:
+            if ext in extensions:
+                self._to_numpy()
+                if writer(fname, _scale(self.img, bits=bits), compression):
+                    return
+        self._to_imagemagick(bits=bits)
         self.img.write(fname)
 
     def min(self):
@@ -310,6 +392,22 @@ class Image(object):
 
             * ``float`` (blur radius) [``min(image dimensions)/20``]
 
+        * ``rotate``: rotate the image counter-clockwise
+
+          * possible calls:
+
+            * ``{'rotate': float}``
+            * ``{'rotate': [float, float, float]}``
+
+          * required arguments:
+
+            * ``float``: rotation angle in degrees
+
+          * optional arguments:
+
+            * ``float``: x-coordinate of the rotation center [image center]
+            * ``float``: y-coordinate of the rotation center [image center]
+
         * ``rgb_sub``: Subtract luminance from each color channel
 
           * possible calls:
@@ -371,6 +469,7 @@ class Image(object):
                      'rgb_sub': self._rgb_subtract,
                      'rgb_mix': self._rgb_mix,
                      'gradient': self._remove_gradient,
+                     'rotate': self._rotate,
                      'stretch': self._stretch}
 
         for key in enhancements:
@@ -612,12 +711,27 @@ class Image(object):
             return polyval2d(x_locs, y_locs, poly).T
 
 
-    def _rotate(self, *args):
-        '''Rotate image.
+    def _rotate(self, args):
+        '''Rotate the image counter-clockwise around the image center
+        or the given location.
+
+        :param args: angle in degrees, and optionally x and y of the
+                     rotation center
+        :type args: list
         '''
-        # use scipy.ndimage.interpolation.rotate()
-        del args
-        LOGGER.error("Image rotation not implemented.")
+        if not isinstance(args, list):
+            args = [args]
+        self._to_numpy()
+        shape = self.img.shape
+        if len(args) < 3:
+            center = ((shape[1] - 1) / 2., (shape[0] - 1) / 2.)
+        else:
+            center = (args[1], args[2])
+        LOGGER.debug("Rotating image %.2f degrees around (%.1f, %.1f).",
+                     args[0], center[0], center[1])
+        img = np.empty_like(self.img)
+        warp(self.img, img, center, center, np.radians(args[0]))
+        self.img = img
 
     def _usm(self, args):
         '''Use unsharp mask to enhance the image contrast.  Uses ImageMagick.
@@ -656,9 +770,11 @@ class Image(object):
         self.img.blur(*args)
 
     def _blur(self, args):
-        '''Blur the image using 1D convolution for each column and
-        row. Data borders are padded with mean of the border area
-        before convolution to reduce the edge effects.
+        '''Blur the image using separable gaussian convolution.  Each
+        channel is convolved first along the rows and then along the
+        columns, a block of lines at a time.  Data borders are padded
+        with mean of the border area before convolution to reduce the
+        edge effects.
         '''
         self._to_numpy()
 
@@ -667,80 +783,51 @@ class Image(object):
             radius = int(np.min(shape[:2])/20.)
             sigma = radius/3.
         else:
-            radius = args[0]
+            radius = int(args[0])
             if len(args) > 1:
                 sigma = args[1]
             else:
                 sigma = radius/3.
 
-        def form_blur_data(data, radius):
-            '''Form vectors for blur.
-            '''
-            vect = np.zeros(2*radius+data.size-1, dtype=data.dtype)
-            vect[:radius] = np.mean(data[:radius])
-            vect[radius:radius+data.size] = data
-            vect[-radius:] = np.mean(data[-radius:])
-
-            return vect
-
-        def gaussian_kernel(radius, sigma):
-            ''' Generate a gaussian convolution kernel.
-
-            'param radius: kernel radius in pixels
-            'type radius: int
-            'param sigma': standard deviation of the gaussian in pixels
-            'type sigma: float
-            '''
-
-            sigma2 = sigma**2
-
-            half_kernel = map(lambda x: 1/(2 * np.pi * sigma2) * \
-                                  np.exp(-x**2 / (2 * sigma2)),
-                              range(radius+1))
-            kernel = np.zeros(2*radius+1)
-            kernel[radius:] = half_kernel
-            kernel[:radius+1] = half_kernel[::-1]
-            kernel /= np.sum(kernel)
-
-            return kernel
-
-        kernel = gaussian_kernel(radius, sigma)
-
         LOGGER.debug("Blur radius is %.0lf pixels and sigma is %.3lf.",
                      radius, sigma)
         LOGGER.debug("Using %d threads.", self._nprocs)
 
-        if self._nprocs > 1:
-            self._pool = Pool(self._nprocs)
-
-        for i in range(shape[-1]):
-            # rows
-            data = []
-            for j in range(shape[0]):
-                data.append([kernel, form_blur_data(self.img[j, :, i],
-                                                    radius)])
-            if self._nprocs > 1:
-                result = self._pool.map(_blur_worker, data)
-            else:
-                result = map(_blur_worker, data)
-
-            # compile result data
-            for j in range(shape[0]):
-                self.img[j, :, i] = result[j][2*radius:2*radius+shape[1]]
-
-            data = []
-            # columns
-            for j in range(shape[1]):
-                data.append([kernel, form_blur_data(self.img[:, j, i],
-                                                    radius)])
-            if self._nprocs > 1:
-                result = self._pool.map(_blur_worker, data)
-            else:
-                result = map(_blur_worker, data)
+        if radius < 1:
+            LOGGER.warning("Blur radius is less than one pixel, skipping.")
+            return
+
+        kernel = _gaussian_kernel(radius, sigma)
+
+        img = self.img
+        if img.ndim == 2:
+            img = img[:, :, np.newaxis]
 
-            # compile result data
-            for j in range(shape[1]):
-                self.img[:, j, i] = result[j][2*radius:2*radius+shape[0]]
+        if self._nprocs > 1:
+            # Workers read and write disjoint line ranges of a shared
+            # copy of the image, so no image data is pickled
+            pool = get_pool(self._nprocs)
+            with SharedArray(img, dtype=np.float64) as shared:
+                for i in range(img.shape[-1]):
+                    # rows, then columns
+                    for axis in (1, 0):
+                        lines = img.shape[1-axis]
+                        data = [(kernel, shared.spec(), i, axis, j,
+                                 j+BLUR_BLOCK_LINES)
+                                for j in range(0, lines, BLUR_BLOCK_LINES)]
+                        pool.map(_blur_worker, data)
+                img[...] = shared.array
+        else:
+            # Keep the intermediate result in full precision, as in
+            # the shared array above
+            work = img.astype(np.float64)
+            for i in range(img.shape[-1]):
+                for axis in (1, 0):
+                    chan = _channel_lines(work, i, axis)
+                    for j in range(0, chan.shape[0], BLUR_BLOCK_LINES):
+                        block = chan[j:j+BLUR_BLOCK_LINES, :]
+                        block[...] = _blur_lines(kernel, block)
+            img[...] = work
 
         self.img -= np.min(self.img)
 
@@ -757,13 +844,491 @@ class Image(object):
         self.img /= self.img.max()
         self.img **= args[0]
 
+def _gaussian_kernel(radius, sigma):
+    '''Generate a normalized gaussian convolution kernel.
+
+    :param radius: kernel radius in pixels
+    :type radius: int
+    :param sigma: standard deviation of the gaussian in pixels
+    :type sigma: float
+    :rtype: Numpy array
+    '''
+    x_locs = np.arange(-radius, radius+1, dtype=np.float64)
+    kernel = np.exp(-x_locs**2 / (2 * sigma**2))
+
+    return kernel / np.sum(kernel)
+
+def _fft_size(size):
+    '''Return the smallest integer not less than *size* that has no
+    prime factors larger than 5.
+    '''
+    best = 2 * size
+    fives = 1
+    while fives < best:
+        threes = fives
+        while threes < best:
+            twos = threes
+            while twos < size:
+                twos *= 2
+            best = min(best, twos)
+            threes *= 3
+        fives *= 5
+
+    return best
+
+def _channel_lines(img, chan, axis):
+    '''Return a view of channel *chan* of 3D image *img* where the
+    lines are along *axis*: 1 for rows and 0 for columns.
+    '''
+    data = img[:, :, chan]
+    if axis == 0:
+        return data.T
+    return data
+
 def _blur_worker(data_in):
-    '''Worker for blurring rows in parallel.
+    '''Worker for blurring a block of lines in a shared image.  The
+    input is (kernel, shared array spec, channel, axis, first line,
+    last line), and the result is written back to the shared image.
     '''
-    kernel = data_in[0]
-    data = data_in[1]
+    kernel, spec, chan, axis, start, stop = data_in
+    block = _channel_lines(attach(spec), chan, axis)[start:stop, :]
+    block[...] = _blur_lines(kernel, block)
+
+def _blur_lines(kernel, data):
+    '''Blur a block of lines.  The lines are padded with the mean of
+    *radius* pixels at each end, and convolved directly for small
+    kernels and using FFT for large kernels.
+    '''
+    data = np.asarray(data, dtype=np.float64)
+
+    radius = kernel.size // 2
+    lines, size = data.shape
+    padded = np.empty((lines, size + 2*radius), dtype=np.float64)
+    padded[:, :radius] = np.mean(data[:, :radius], 1)[:, np.newaxis]
+    padded[:, radius:radius+size] = data
+    padded[:, radius+size:] = np.mean(data[:, size-radius:], 1)[:, np.newaxis]
+
+    if radius <= BLUR_DIRECT_RADIUS:
+        result = kernel[0] * padded[:, :size]
+        for i in range(1, kernel.size):
+            result += kernel[i] * padded[:, i:i+size]
+        return result
+
+    fft_size = _fft_size(padded.shape[1] + kernel.size - 1)
+    result = np.fft.irfft(np.fft.rfft(padded, fft_size, axis=1) *
+                          np.fft.rfft(kernel, fft_size), fft_size, axis=1)
+
+    return result[:, 2*radius:2*radius+size]
+
+class AsyncWriter(object):
+    '''Save images in background threads.  The images are copied when
+    submitted, so they can be modified while they are being saved.
+    Errors in saving are raised on the next call to save(), flush()
+    or close().
+
+    :param threads: number of writer threads
+    :type threads: int
+    :param queue_size: maximum number of images waiting to be saved.
+                       Submitting more blocks until there is room.
+    :type queue_size: int
+    '''
+
+    def __init__(self, threads=1, queue_size=4):
+        self._queue = Queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._threads = []
+        for _ in range(max(1, threads)):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Don't hide the original exception
+            try:
+                self.close()
+            except Exception: # pylint: disable=broad-except
+                pass
+
+    def save(self, img, fname, **kwargs):
+        '''Submit image to be saved.
+
+        :param img: image to save
+        :type img: halostack.image.Image
+        :param fname: output filename
+        :type fname: str
+        :param kwargs: keyword arguments passed to Image.save()
+        :type kwargs: dict
+        '''
+        self._check_error()
+        if not self._threads:
+            raise ValueError("Writer is closed.")
+        img = Image(img=np.array(img[...]))
+        self._queue.put((img, fname, kwargs))
+
+    def flush(self):
+        '''Wait until all the submitted images are saved.
+        '''
+        self._queue.join()
+        self._check_error()
+
+    def close(self):
+        '''Save the remaining images and stop the threads.
+        '''
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._check_error()
+
+    def _check_error(self):
+        '''Raise the error from saving, if any.
+        '''
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _worker(self):
+        '''Save images from the queue until None is received.
+        '''
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                img, fname, kwargs = item
+                img.save(fname, **kwargs)
+            except Exception as err: # pylint: disable=broad-except
+                LOGGER.error("Saving %s failed: %s", fname, err)
+                if self._error is None:
+                    self._error = err
+            finally:
+                self._queue.task_done()
+
+class FrameCache(object):
+    '''Disk cache for decoded images.  The images are stored as .npy
+    files named by a hash of the image path, modification time and
+    size, so changed files are decoded again.  When the cache grows
+    larger than *max_size*, the least recently used images are
+    removed.  The cache can be used from several threads.
+
+    :param directory: cache directory
+    :type directory: str
+    :param max_size: maximum size of the cache in bytes
+    :type max_size: int
+    '''
+
+    def __init__(self, directory, max_size=10 * 1024**3):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, fname):
+        '''Return the cache file path for image *fname*.
+        '''
+        fname = os.path.abspath(fname)
+        stat = os.stat(fname)
+        key = hashlib.sha1(repr((fname, stat.st_mtime,
+                                 stat.st_size)).encode('utf-8'))
+        return os.path.join(self.directory, key.hexdigest() + '.npy')
+
+    def get(self, fname):
+        '''Return the cached data of image *fname*, or None if the image
+        is not in the cache.  The data are memory-mapped copy-on-write,
+        so modifying them doesn't change the cache.
+
+        :param fname: image filename
+        :type fname: str
+        :rtype: Numpy ndarray or None
+        '''
+        path = self._path(fname)
+        try:
+            data = np.load(path, mmap_mode='c')
+        except (IOError, OSError, ValueError):
+            return None
+        LOGGER.debug("Read %s from cache.", fname)
+        # Update the access time for LRU.  The file may have been
+        # removed by another thread after it was opened.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return data
+
+    def put(self, fname, data):
+        '''Store image data to the cache.
+
+        :param fname: image filename
+        :type fname: str
+        :param data: decoded image data
+        :type data: Numpy ndarray
+        '''
+        path = self._path(fname)
+        # Write to a temporary file first, so that partial files are
+        # never read
+        fid, tmp_path = tempfile.mkstemp(dir=self.directory,
+                                         suffix='.tmp')
+        try:
+            with os.fdopen(fid, 'wb') as fid:
+                np.save(fid, data)
+            with self._lock:
+                os.rename(tmp_path, path)
+                LOGGER.debug("Added %s to cache.", fname)
+                self._evict()
+        except (IOError, OSError) as err:
+            LOGGER.warning("Caching %s failed: %s", fname, err)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _evict(self):
+        '''Remove least recently used images until the cache size is
+        within the limit.  Files removed meanwhile, eg. by another
+        process using the same cache, are skipped.
+        '''
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npy'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_size:
+                break
+            LOGGER.debug("Removing %s from cache.", path)
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+def register_reader(extensions, reader):
+    '''Register an image reader.  Readers registered later are tried
+    first.
+
+    :param extensions: lowercase filename extensions, eg. ('.jpg',)
+    :type extensions: tuple of str
+    :param reader: function returning the image as (rows, columns,
+                   channels) or (rows, columns) Numpy ndarray, or None
+                   if it can't read the image
+    :type reader: function
+    '''
+    READERS.insert(0, (tuple(extensions), reader))
+
+def _read_pillow(fname):
+    '''Read 8-bit image using Pillow.  Pillow reduces 16-bit RGB and
+    RGBA PNG images to 8 bits, so PNG images with more than 8 bits are
+    left to other readers.
+    '''
+    if PILImage is None:
+        return None
+    if _png_bit_depth(fname) > 8:
+        return None
+    img = PILImage.open(fname)
+    if img.mode in ('P', 'RGBA', 'CMYK', 'YCbCr'):
+        img = img.convert('RGB')
+    elif img.mode not in ('RGB', 'L'):
+        # 16-bit and floating point modes are left to other readers
+        return None
+    return np.asarray(img)
+
+def _png_bit_depth(fname):
+    '''Return the bit depth of PNG image *fname* from the IHDR chunk,
+    or 0 if the file isn't a PNG image.
+    '''
+    with open(fname, 'rb') as fid:
+        header = fid.read(25)
+    if len(header) < 25 or header[:8] != b'\x89PNG\r\n\x1a\n' or \
+            header[12:16] != b'IHDR':
+        return 0
+
+    return struct.unpack('>B', header[24:25])[0]
+
+def _read_tifffile(fname):
+    '''Read TIFF image using tifffile.
+    '''
+    if tifffile is None:
+        return None
+    img = tifffile.imread(fname)
+    if img.ndim == 3 and img.shape[2] > 3:
+        # Discard alpha channel
+        img = img[:, :, :3]
+    return img
+
+def _read_rawpy(fname):
+    '''Read and demosaic camera RAW image using rawpy.  The result is a
+    16-bit image with camera white balance.
+    '''
+    if rawpy is None:
+        return None
+    raw = rawpy.imread(fname)
+    try:
+        return raw.postprocess(output_bps=16, use_camera_wb=True)
+    finally:
+        raw.close()
+
+# Image readers as (filename extensions, reader function) tuples
+READERS = [(('.jpg', '.jpeg', '.png'), _read_pillow),
+           (('.tif', '.tiff'), _read_tifffile),
+           (RAW_EXTENSIONS, _read_rawpy)]
+
+def _png_chunk(chunk_type, data):
+    '''Return PNG chunk with length and CRC.
+    '''
+    crc = zlib.crc32(chunk_type + data) & 0xffffffff
+    return struct.pack('>I', len(data)) + chunk_type + data + \
+        struct.pack('>I', crc)
+
+def _write_png(fname, img, compression):
+    '''Write 8- or 16-bit grayscale or RGB image as PNG.  The image
+    rows are filtered and compressed in blocks, so only a block of the
+    image is copied at a time.  Data with more than 16 bits are scaled
+    to 16 bits.
+    '''
+    if img.ndim == 3 and img.shape[2] == 1:
+        img = img[:, :, 0]
+    if img.ndim == 2:
+        color_type = 0
+    elif img.shape[2] == 3:
+        color_type = 2
+    else:
+        return False
+    if img.dtype not in (np.uint8, np.uint16):
+        LOGGER.debug("PNG supports at most 16 bits.")
+        img = _scale(img, bits=16)
+    bits = 8 * img.dtype.itemsize
+    rows, cols = img.shape[:2]
+    # Bytes per pixel
+    bpp = img.dtype.itemsize
+    if img.ndim == 3:
+        bpp *= img.shape[2]
+
+    compressor = zlib.compressobj(compression)
+    idat = []
+    prev = np.zeros(cols * bpp, dtype=np.uint8)
+    for start in range(0, rows, PNG_BLOCK_ROWS):
+        # PNG data are big-endian
+        block = img[start:start+PNG_BLOCK_ROWS].astype(
+            '>u%d' % img.dtype.itemsize)
+        block = block.view(np.uint8).reshape((block.shape[0], -1))
+        idat.append(compressor.compress(
+            _png_filter(block, prev, bpp).tobytes()))
+        prev = block[-1]
+    idat.append(compressor.flush())
+
+    with open(fname, 'wb') as fid:
+        fid.write(b'\x89PNG\r\n\x1a\n')
+        fid.write(_png_chunk(b'IHDR', struct.pack('>IIBBBBB', cols, rows,
+                                                  bits, color_type,
+                                                  0, 0, 0)))
+        fid.write(_png_chunk(b'IDAT', b''.join(idat)))
+        fid.write(_png_chunk(b'IEND', b''))
+
+    return True
+
+def _png_filter(block, prev, bpp):
+    '''Filter the rows of *block* for PNG compression.  Each row is
+    filtered with the filter type giving the smallest sum of absolute
+    values of the filtered bytes as signed numbers, as recommended in
+    the PNG specification.
+
+    :param block: image rows as bytes
+    :type block: Numpy array
+    :param prev: image row before the block, as bytes
+    :type prev: Numpy array
+    :param bpp: number of bytes per pixel
+    :type bpp: int
+    :rtype: Numpy array of rows starting with the filter type byte
+    '''
+    cur = block.astype(np.int16)
+    upper = np.empty_like(cur)
+    upper[0] = prev
+    upper[1:] = cur[:-1]
+    left = np.zeros_like(cur)
+    left[:, bpp:] = cur[:, :-bpp]
+    upper_left = np.zeros_like(cur)
+    upper_left[:, bpp:] = upper[:, :-bpp]
+
+    out = np.empty((block.shape[0], block.shape[1] + 1), dtype=np.uint8)
+    out[:, 0] = 0
+    out[:, 1:] = block
+    costs = _png_filter_cost(out[:, 1:])
+
+    # Sub, Up, Average and Paeth predictors
+    dist_left = np.abs(upper - upper_left)
+    dist_upper = np.abs(left - upper_left)
+    dist_upper_left = np.abs(left + upper - 2 * upper_left)
+    paeth = np.where((dist_left <= dist_upper) &
+                     (dist_left <= dist_upper_left), left,
+                     np.where(dist_upper <= dist_upper_left, upper,
+                              upper_left))
+    predictors = (left, upper, (left + upper) // 2, paeth)
+    for filter_type, predictor in enumerate(predictors, 1):
+        filtered = (cur - predictor).astype(np.uint8)
+        filter_costs = _png_filter_cost(filtered)
+        better = filter_costs < costs
+        costs[better] = filter_costs[better]
+        out[better, 0] = filter_type
+        out[better, 1:] = filtered[better]
+
+    return out
+
+def _png_filter_cost(filtered):
+    '''Return the sum of absolute values of the filtered bytes as
+    signed numbers for each row.
+    '''
+    filtered = filtered.astype(np.int32)
+
+    return np.sum(np.minimum(filtered, 256 - filtered), -1)
+
+def _write_tifffile(fname, img, compression):
+    '''Write TIFF image using tifffile.  The deflate compression level
+    is given in the way the installed tifffile version supports: as
+    compression arguments in current versions, as (compression,
+    level) tuple in older ones, and with *compress* keyword in the
+    oldest ones.  Versions without imwrite() use imsave().
+    '''
+    if tifffile is None:
+        return False
+    if img.ndim == 3 and img.shape[2] == 1:
+        img = img[:, :, 0]
+
+    write = getattr(tifffile, 'imwrite', None) or tifffile.imsave
+    if not compression:
+        write(fname, img)
+        return True
+    options = [{'compression': 'zlib',
+                'compressionargs': {'level': compression}},
+               {'compression': ('zlib', compression)},
+               {'compress': compression}]
+    for kwargs in options[:-1]:
+        try:
+            write(fname, img, **kwargs)
+            return True
+        except TypeError:
+            continue
+    write(fname, img, **options[-1])
+
+    return True
 
-    return np.convolve(data, kernel, mode='full')
+# Image writers as (filename extensions, writer function) tuples.
+# Writers return False if they can't write the image.
+WRITERS = [(('.png',), _write_png),
+           (('.tif', '.tiff'), _write_tifffile)]
 
 def to_numpy(img):
     '''Convert ImageMagick data to numpy array.
@@ -777,7 +1342,10 @@ def to_numpy(img):
         img.magick('RGB')
         blob = Blob()
         img.write(blob)
-        out_img = np.fromstring(blob.data, dtype='uint'+str(img.depth()))
+        # The blob data are read-only, and the images are modified in
+        # place, so copy the data once
+        out_img = np.frombuffer(blob.data,
+                                dtype='uint'+str(img.depth())).copy()
 
         height, width, chans = img.rows(), img.columns(), 3
         if img.monochrome():
@@ -827,7 +1395,8 @@ def to_imagemagick(img, bits=16):
 
 
 def _scale(img, bits=16):
-    '''Scale image to cover the whole bit-range.
+    '''Scale image to cover the whole bit-range.  The given image is
+    not modified.
     '''
 
     if img.dtype.name == 'uint%d' % bits:
@@ -835,10 +1404,11 @@ def _scale(img, bits=16):
 
     LOGGER.debug("Scaling image to %d bits.", bits)
 
-    img -= img.min()
+    img = np.subtract(img, img.min(), dtype=np.float64)
     img_max = np.max(img)
     if img_max != 0:
-        img = (2**bits - 1) * img / img_max
+        img *= 2**bits - 1
+        img /= img_max
 
     if bits <= 8:
         return img.astype('uint8')
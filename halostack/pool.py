@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014, 2015 Panu Lahtinen
+
+# Author(s):
+
+# Panu Lahtinen <pnuu+git@iki.fi>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''Module for the worker process and thread pools shared by all the
+halostack classes'''
+
+import atexit
+import logging
+import os
+import tempfile
+from contextlib import contextmanager
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+# Directory for the shared array files.  Use memory-backed file system
+# if available.
+if os.path.isdir('/dev/shm'):
+    SHARED_DIR = '/dev/shm'
+else:
+    SHARED_DIR = None
+
+# The shared pools and their sizes
+_POOL = {'pool': None, 'nprocs': 0}
+_THREAD_POOL = {'pool': None, 'nprocs': 0}
+
+def get_pool(nprocs):
+    '''Get the shared worker pool having at least *nprocs* processes.
+    The pool is created on first use, and re-created if more
+    processes are requested than the current pool has.
+
+    :param nprocs: number of parallel processes
+    :type nprocs: int
+    :rtype: multiprocessing.Pool or None if *nprocs* is less than 2
+    '''
+    if nprocs < 2:
+        return None
+    if _POOL['pool'] is not None and _POOL['nprocs'] >= nprocs:
+        return _POOL['pool']
+
+    _close(_POOL, "worker processes")
+    LOGGER.debug("Starting a pool of %d worker processes.", nprocs)
+    _POOL['pool'] = Pool(nprocs)
+    _POOL['nprocs'] = nprocs
+
+    return _POOL['pool']
+
+def get_thread_pool(nthreads):
+    '''Get the shared thread pool having at least *nthreads* threads.
+    Threads are enough for work done mostly in Numpy, which releases
+    GIL.  The pool is created on first use, and re-created if more
+    threads are requested than the current pool has.
+
+    :param nthreads: number of parallel threads
+    :type nthreads: int
+    :rtype: multiprocessing.pool.ThreadPool or None if *nthreads* is
+            less than 2
+    '''
+    if nthreads < 2:
+        return None
+    if _THREAD_POOL['pool'] is not None and \
+            _THREAD_POOL['nprocs'] >= nthreads:
+        return _THREAD_POOL['pool']
+
+    _close(_THREAD_POOL, "threads")
+    LOGGER.debug("Starting a pool of %d threads.", nthreads)
+    _THREAD_POOL['pool'] = ThreadPool(nthreads)
+    _THREAD_POOL['nprocs'] = nthreads
+
+    return _THREAD_POOL['pool']
+
+def shutdown():
+    '''Close the shared worker and thread pools, if any, and wait for
+    the workers to exit.
+    '''
+    _close(_POOL, "worker processes")
+    _close(_THREAD_POOL, "threads")
+
+def _close(pool, kind):
+    '''Close the *pool* of *kind* workers and wait for them to exit.
+    '''
+    if pool['pool'] is None:
+        return
+    LOGGER.debug("Closing the pool of %d %s.", pool['nprocs'], kind)
+    pool['pool'].close()
+    pool['pool'].join()
+    pool['pool'] = None
+    pool['nprocs'] = 0
+
+@contextmanager
+def worker_pool(nprocs):
+    '''Context manager giving the shared worker pool.  The worker and
+    thread pools are closed on exit.
+
+    :param nprocs: number of parallel processes
+    :type nprocs: int
+    '''
+    try:
+        yield get_pool(nprocs)
+    finally:
+        shutdown()
+
+class SharedArray(object):
+    '''Numpy array in a memory-mapped temporary file.  Worker processes
+    attach to the array by name, so only the name and the indices need
+    to be sent to them instead of pickled data.
+
+    :param data: data to be copied to the shared array
+    :type data: Numpy array
+    :param dtype: data type of the shared array [dtype of *data*]
+    :type dtype: Numpy dtype or None
+    '''
+
+    def __init__(self, data, dtype=None):
+        if dtype is None:
+            dtype = data.dtype
+        fid, self.name = tempfile.mkstemp(prefix='halostack_',
+                                          suffix='.dat', dir=SHARED_DIR)
+        os.close(fid)
+        self.shape = tuple(data.shape)
+        self.dtype = np.dtype(dtype).str
+        LOGGER.debug("Creating shared array %s.", self.name)
+        self.array = np.memmap(self.name, dtype=self.dtype, mode='w+',
+                               shape=self.shape)
+        self.array[...] = data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def spec(self):
+        '''Return the information needed to attach to the array.
+
+        :rtype: 3-tuple
+        '''
+        return (self.name, self.shape, self.dtype)
+
+    def close(self):
+        '''Release the array and remove the backing file.
+        '''
+        if self.array is None:
+            return
+        LOGGER.debug("Removing shared array %s.", self.name)
+        self.array = None
+        os.remove(self.name)
+
+def attach(spec, mode='r+'):
+    '''Attach to a shared array.
+
+    :param spec: shared array specification from SharedArray.spec()
+    :type spec: 3-tuple
+    :param mode: memory map mode, 'r' for read-only and 'r+' for
+                 read-write access
+    :type mode: str
+    :rtype: Numpy memmap
+    '''
+    name, shape, dtype = spec
+
+    return np.memmap(name, dtype=dtype, mode=mode, shape=shape)
+
+atexit.register(shutdown)
@@ -24,11 +24,31 @@
 
 import numpy as np
 import logging
+import tempfile
+from collections import deque
 from halostack.image import Image
+from halostack.pool import get_thread_pool
 
 LOGGER = logging.getLogger(__name__)
 
 STACK_DTYPE = np.float64
+# Default memory budget, in megabytes, for processing the disk-backed
+# deep stacks
+DEEP_MEMORY = 1024
+# Ratio of working memory needed for calculations to the size of the
+# processed stack data
+DEEP_MEMORY_OVERHEAD = 4
+# Floating point images stored as integers are scaled so that values
+# up to this many times the maximum of the first image fit in the
+# integer range
+DEEP_SCALE_HEADROOM = 2.
+# Limits for the default number of histogram bins for the approximate
+# median stack
+APPROX_MEDIAN_MIN_BINS = 16
+APPROX_MEDIAN_MAX_BINS = 256
+# Approximate size of the tiles, in bytes, processed by one thread when
+# calculating results.  Small enough to keep the working set in cache.
+TILE_BYTES = 4 * 1024**2
 
 class Stack(object):
     '''Class for image stacks.
@@ -43,8 +63,45 @@ class Stack(object):
     'min' - minimum stack
     'max' - maximum stack
     'mean' - average stack
+    'wmean' - weighted average stack, see add_image()
+    'std' - standard deviation stack
+    'var' - variance stack
     'median' - median stack
     'sigma' - kappa-sigma stack
+    'approx_median' - approximate median stack using constant memory
+
+    Keyword arguments for the average stack::
+
+    'compensated' - use Kahan summation to reduce rounding errors for
+                    long image series
+
+    Keyword arguments for the deep stacks ('median' and 'sigma')::
+
+    'disk' - store the images to a temporary file instead of memory
+    'tmpdir' - directory for the temporary file
+    'memory' - memory budget in megabytes for calculating the result
+               from the disk-backed stack [DEEP_MEMORY]
+    'dtype' - data type used for storing the images, eg. 'uint16' for
+              16-bit images [dtype of the first image].  Floating
+              point images stored as integers are scaled by the
+              integer maximum divided by DEEP_SCALE_HEADROOM times the
+              maximum of the first image, and the result is scaled
+              back.  Values outside the integer range are clipped
+
+    Keyword arguments for the approximate median stack::
+
+    'bins' - number of histogram bins for each pixel.  The maximum
+             error of the median is the bin width,
+             (range[1] - range[0]) / bins, and the histograms take
+             bins times 1, 2 or 4 bytes for each pixel and channel,
+             depending on the maximum number of images.  The default
+             uses at most as much memory as the images would, limited
+             to APPROX_MEDIAN_MIN_BINS - APPROX_MEDIAN_MAX_BINS bins and
+             the number of values of integer data
+    'range' - value range (min, max) of the histograms.  Values outside
+              the range are counted to the first or last bin.  Default
+              is the range of the first image, doubled whenever an
+              image has values outside it
     '''
 
     def __init__(self, mode, num, nprocs=1, kwargs=None):
@@ -58,31 +115,61 @@ class Stack(object):
                                 'max': {'update': self._update_max,
                                         'calc': None},
                                 'mean': {'update': self._update_mean,
-                                         'calc': None},
+                                         'calc': self._calculate_mean},
+                                'wmean': {'update': self._update_wmean,
+                                          'calc': self._calculate_wmean},
+                                'std': {'update': self._update_welford,
+                                        'calc': self._calculate_std},
+                                'var': {'update': self._update_welford,
+                                        'calc': self._calculate_var},
                                 'sigma': {'update': self._update_deep,
                                           'calc': self._calculate_sigma},
                                 'median': {'update': self._update_deep,
-                                           'calc': self._calculate_median}}
+                                           'calc': self._calculate_median},
+                                'approx_median':
+                                    {'update': self._update_approx_median,
+                                     'calc': self._calculate_approx_median}}
         self._update_func = self._mode_functions[mode]['update']
         self._calculate_func = self._mode_functions[mode]['calc']
         self.num = num
         self._num = 0
         self._kwargs = kwargs
+        self._tmpfile = None
+        self._tile_rows = None
+        self._img_shape = None
+        self._hist_range = None
+        self._luminance = None
+        self._compensation = None
+        self._buffers = None
+        self._weight_sum = 0.
+        self._m2 = None
+        self._scale = None
+
+    def _get_kwarg(self, key, default=None):
+        '''Get keyword argument *key*, or *default* if it is not given.
+        '''
+        try:
+            return self._kwargs[key]
+        except (TypeError, KeyError):
+            return default
 
-    def add_image(self, img):
+    def add_image(self, img, weight=None):
         '''Add a frame to the stack.
 
         :param img: image to be added to stack
         :type img: halostack.image.Image
+        :param weight: weight of the image, used only by the weighted
+                       average stack [1.0]
+        :type weight: float or None
         '''
 
-        if not isinstance(img, Image):
+        if not isinstance(img, (Image, _Frame)):
             LOGGER.debug("Converting %s to Image object.", img)
             img = Image(img=img, nprocs=self.nprocs)
 
         LOGGER.debug("Adding image to %s stack.", self.mode)
 
-        self._update_stack(img)
+        self._update_stack(img, weight=weight)
 
     def calculate(self):
         '''Calculate the result image and return Image object.
@@ -96,132 +183,653 @@ class Stack(object):
 
         return self._calculate_func()
 
-    def _update_stack(self, img):
+    def _update_stack(self, img, weight=None):
         '''Update the stack
         '''
-        self._update_func(img)
+        if not isinstance(img, _Frame):
+            img = _Frame(img)
+        self._update_func(img, weight)
         self._num += 1
 
-    def _update_mean(self, img):
-        '''Update average stack
+    def _update_mean(self, frame, weight=None):
+        '''Update average stack.  The images are summed in-place to a
+        preallocated buffer, optionally with Kahan compensation of the
+        rounding errors.
         '''
+        del weight
+        data = frame.data
+        if self.stack is None:
+            self.stack = Image(img=np.array(data, dtype=STACK_DTYPE),
+                               nprocs=self.nprocs)
+            if self._get_kwarg('compensated', False):
+                self._compensation = np.zeros(data.shape, dtype=STACK_DTYPE)
+                self._buffers = (np.empty(data.shape, dtype=STACK_DTYPE),
+                                 np.empty(data.shape, dtype=STACK_DTYPE))
+            return
+
+        if self._compensation is None:
+            np.add(self.stack.img, data, out=self.stack.img)
+            return
+
+        # Kahan summation
+        corrected, total = self._buffers
+        np.subtract(data, self._compensation, out=corrected)
+        np.add(self.stack.img, corrected, out=total)
+        np.subtract(total, self.stack.img, out=self._compensation)
+        self._compensation -= corrected
+        self._buffers = (corrected, self.stack.img)
+        self.stack.img = total
+
+    def _calculate_mean(self):
+        '''Calculate the average from the sum of the images.
+        '''
+        return Image(img=self.stack.img / self._num, nprocs=self.nprocs)
 
+    def _update_wmean(self, frame, weight=None):
+        '''Update weighted average stack.
+        '''
+        if weight is None:
+            weight = 1.0
+        if weight < 0:
+            raise ValueError("Image weight can not be negative.")
+        LOGGER.debug("Image weight: %.3f.", weight)
+
+        data = frame.data
         if self.stack is None:
-            img.set_dtype(STACK_DTYPE)
-            self.stack = img
-        else:
-            self.stack += img
+            self.stack = Image(img=np.zeros(data.shape, dtype=STACK_DTYPE),
+                               nprocs=self.nprocs)
+            self._buffers = np.empty(data.shape, dtype=STACK_DTYPE)
+            self._weight_sum = 0.
+
+        np.multiply(data, weight, out=self._buffers)
+        np.add(self.stack.img, self._buffers, out=self.stack.img)
+        self._weight_sum += weight
+
+    def _calculate_wmean(self):
+        '''Calculate the weighted average from the weighted sum of the
+        images.
+        '''
+        if self._weight_sum <= 0:
+            raise ValueError("Sum of the image weights is zero, can not "
+                             "calculate weighted average.")
+        return Image(img=self.stack.img / self._weight_sum,
+                     nprocs=self.nprocs)
+
+    def _update_welford(self, frame, weight=None):
+        '''Update running mean and sum of squared differences using
+        Welford's algorithm.
+        '''
+        del weight
+        data = frame.astype(STACK_DTYPE)
+        if self.stack is None:
+            self.stack = Image(img=np.array(data, dtype=STACK_DTYPE),
+                               nprocs=self.nprocs)
+            self._m2 = np.zeros(data.shape, dtype=STACK_DTYPE)
+            self._buffers = (np.empty(data.shape, dtype=STACK_DTYPE),
+                             np.empty(data.shape, dtype=STACK_DTYPE))
+            return
+
+        delta, delta2 = self._buffers
+        np.subtract(data, self.stack.img, out=delta)
+        np.divide(delta, self._num + 1., out=delta2)
+        self.stack.img += delta2
+        np.subtract(data, self.stack.img, out=delta2)
+        delta *= delta2
+        self._m2 += delta
+
+    def _calculate_var(self):
+        '''Calculate variance of the images.
+        '''
+        return Image(img=self._m2 / self._num, nprocs=self.nprocs)
+
+    def _calculate_std(self):
+        '''Calculate standard deviation of the images.
+        '''
+        return Image(img=np.sqrt(self._m2 / self._num), nprocs=self.nprocs)
 
-    def _update_min(self, img):
+    def noise(self):
+        '''Return the per-pixel noise (standard deviation) of the
+        images.  Available only for 'std' and 'var' stacks.
+
+        :rtype: halostack.image.Image or None
+        '''
+        if self.mode not in ('std', 'var'):
+            LOGGER.error("Noise is available only for std and var stacks.")
+            return None
+        if self._m2 is None:
+            LOGGER.error("No images in the stack.")
+            return None
+        return self._calculate_std()
+
+    def _update_min(self, frame, weight=None):
         '''Update minimum stack. Minimum values are selected using
         luminance.
         '''
-        if self.stack is None:
-            self.stack = img
-        else:
-            lum_stack = self.stack.luminance()
-            lum_img = img.luminance()
-            idxs_y, idxs_x = np.where(lum_stack > lum_img)
-            if np.any(idxs_x):
-                for i in range(img.img.shape[-1]):
-                    self.stack.img[idxs_y, idxs_x, i] = img[idxs_y, idxs_x, i]
-
+        del weight
+        self._update_extremum(frame, np.less)
 
-    def _update_max(self, img):
+    def _update_max(self, frame, weight=None):
         '''Update maximum stack. Maximum values are selected using
         luminance.
         '''
+        del weight
+        self._update_extremum(frame, np.greater)
+
+    def _update_extremum(self, frame, compare):
+        '''Update minimum or maximum stack.  Pixels where *compare* of
+        the image and stack luminances is true are copied from the
+        image.  Luminance of the stack is cached and updated with the
+        copied pixels, so it isn't recalculated for every image.
+        '''
+        data = frame.data
+        lum = frame.luminance()
 
         if self.stack is None:
-            self.stack = img
-        else:
-            lum_stack = self.stack.luminance()
-            lum_img = img.luminance()
-            idxs_y, idxs_x = np.where(lum_stack < lum_img)
-            if np.any(idxs_x):
-                for i in range(img.img.shape[-1]):
-                    self.stack[idxs_y, idxs_x, i] = img[idxs_y, idxs_x, i]
-
-
-    def _update_deep(self, img):
-        '''Update deep (median or sigma-reject average) stack.
+            # Copy, so that the stacks don't share the data
+            self.stack = Image(img=data.copy(), nprocs=self.nprocs)
+            self._luminance = np.array(lum, dtype=STACK_DTYPE)
+            return
+
+        mask = compare(lum, self._luminance)
+        np.copyto(self._luminance, lum, where=mask)
+        if data.ndim > 2:
+            mask = mask[:, :, np.newaxis]
+        np.copyto(self.stack.img, data, where=mask, casting='unsafe')
+
+    def _update_deep(self, frame, weight=None):
+        '''Update deep (median or sigma-reject average) stack.  The
+        images are stored frame-major, as (images, rows, columns,
+        channels) array, so adding an image is a single contiguous
+        copy.
         '''
+        del weight
+        data = frame.data
         if self.stack is None:
-            self.stack = {}
-            shape = img.img.shape[:2]
-            self.stack['R'] = np.empty((shape[0], shape[1], self.num),
-                                       dtype=img.img.dtype)
-            self.stack['G'] = np.empty((shape[0], shape[1], self.num),
-                                       dtype=img.img.dtype)
-            self.stack['B'] = np.empty((shape[0], shape[1], self.num),
-                                       dtype=img.img.dtype)
-
-        self.stack['R'][:, :, self._num] = img[:, :, 0]
-        self.stack['G'][:, :, self._num] = img[:, :, 1]
-        self.stack['B'][:, :, self._num] = img[:, :, 2]
+            self._img_shape = data.shape
+            dtype = np.dtype(self._get_kwarg('dtype', data.dtype))
+            if self._get_kwarg('disk', False):
+                self._create_disk_stack(dtype)
+            else:
+                LOGGER.debug("Storing %s stack to memory as %s.",
+                             self.mode, dtype.name)
+                self.stack = np.empty((self.num,) + self._img_shape[:2] +
+                                      (self._chans(),), dtype=dtype)
+            if np.issubdtype(dtype, np.integer) and \
+                    not np.issubdtype(data.dtype, np.integer) and \
+                    np.max(data) > 0:
+                self._scale = np.iinfo(dtype).max / \
+                    (DEEP_SCALE_HEADROOM * float(np.max(data)))
+                LOGGER.debug("Scaling images by %g for storage.",
+                             self._scale)
+
+        if np.issubdtype(self.stack.dtype, np.integer) and \
+                not np.can_cast(data.dtype, self.stack.dtype):
+            info = np.iinfo(self.stack.dtype)
+            scale = self._scale or 1.
+            if np.min(data) * scale < info.min or \
+                    np.max(data) * scale > info.max:
+                LOGGER.warning("Image values outside the range of %s "
+                               "storage are clipped.", self.stack.dtype.name)
+        data = frame.astype(self.stack.dtype, scale=self._scale)
+        data = data.reshape(self._img_shape[:2] + (self._chans(),))
+        if self._tile_rows is None:
+            self.stack[self._num] = data
+            return
+
+        for i in range(self.stack.shape[0]):
+            rows = data[i*self._tile_rows:(i+1)*self._tile_rows]
+            self.stack[i, self._num, :rows.shape[0]] = rows
+
+    def _create_disk_stack(self, dtype):
+        '''Create disk-backed deep stack.  The data are stored in a
+        temporary file as tiles of *self._tile_rows* image rows, and
+        each tile holds the data of all the images, so that the tiles
+        can be read one at a time when calculating the result.
+        '''
+        shape = self._img_shape[:2] + (self._chans(),)
+        # Each thread processes its own tile
+        memory = (self._get_kwarg('memory', DEEP_MEMORY) * 1024**2 //
+                  max(1, self.nprocs))
+        row_size = (self.num * shape[1] * shape[2] * dtype.itemsize *
+                    DEEP_MEMORY_OVERHEAD)
+        self._tile_rows = int(min(shape[0], max(1, memory // row_size)))
+        num_tiles = -(-shape[0] // self._tile_rows)
+        self._tmpfile = tempfile.TemporaryFile(prefix='halostack_',
+                                               dir=self._get_kwarg('tmpdir'))
+        LOGGER.debug("Storing %s stack to disk as %s in %d tiles of %d "
+                     "rows.", self.mode, dtype.name, num_tiles,
+                     self._tile_rows)
+        self.stack = np.memmap(self._tmpfile, dtype=dtype, mode='w+',
+                               shape=(num_tiles, self.num,
+                                      self._tile_rows) + shape[1:])
+
+    def _chans(self):
+        '''Return the number of channels in the stacked images.
+        '''
+        if len(self._img_shape) > 2:
+            return self._img_shape[2]
+        return 1
+
+    def _deep_tiles(self):
+        '''Iterate over the deep stack data.  Yields the first and last
+        row of each tile and a list of (images, rows, columns) arrays,
+        one for each channel.  Tiles read from the disk-backed stack
+        are split further for the threads.
+        '''
+        rows = self._img_shape[0]
+        if self._tile_rows is None:
+            tile_rows = self._task_rows(self.stack[:self._num, 0], rows)
+            for start in range(0, rows, tile_rows):
+                stop = min(start + tile_rows, rows)
+                tile = self.stack[:self._num, start:stop]
+                yield (start, stop, [tile[..., i]
+                                     for i in range(tile.shape[-1])])
+            return
+
+        for i in range(self.stack.shape[0]):
+            start = i * self._tile_rows
+            stop = min(start + self._tile_rows, rows)
+            tile = np.array(self.stack[i, :self._num, :stop-start])
+            task_rows = self._task_rows(tile[:, 0], stop - start)
+            for j in range(0, stop - start, task_rows):
+                part = tile[:, j:j+task_rows]
+                yield (start + j, start + j + part.shape[1],
+                       [part[..., k] for k in range(part.shape[-1])])
+
+    def _task_rows(self, row, rows):
+        '''Return the number of rows in the tiles processed by one
+        thread, when *row* is the data of one image row and *rows* is
+        the number of rows to be split.  The tiles are small enough to
+        keep the working set in cache, and there is at least one tile
+        channel for each thread.
+        '''
+        tiles = -(-self.nprocs // self._chans())
+
+        return max(1, min(_tile_rows(row), -(-rows // tiles)))
+
+    def _map_tiles(self, func, tiles, dtype):
+        '''Apply *func* to each channel of the tiles given by iterator
+        *tiles*, and assemble the results to an image.  The tiles are
+        processed in the shared thread pool; Numpy releases GIL, so
+        threads are enough.  Only a limited number of tiles are read ahead, so
+        that disk-backed stacks are not read to memory at once.
+
+        :param func: function calculating (rows, columns) result array
+                     from one channel of a tile
+        :type func: function
+        :param tiles: iterator yielding (first row, last row, list of
+                      channels) for each tile
+        :type tiles: iterator
+        :param dtype: data type of the result
+        :type dtype: Numpy dtype
+        :rtype: halostack.image.Image
+        '''
+        img = np.empty(self._img_shape, dtype=dtype)
+        out = img.reshape(self._img_shape[:2] + (self._chans(),))
+
+        if self.nprocs < 2:
+            for start, stop, chans in tiles:
+                for i, chan in enumerate(chans):
+                    out[start:stop, :, i] = func(chan)
+            return Image(img=img, nprocs=self.nprocs)
+
+        pool = get_thread_pool(self.nprocs)
+        pending = deque()
+        for start, stop, chans in tiles:
+            for i, chan in enumerate(chans):
+                pending.append((start, stop, i,
+                                pool.apply_async(func, (chan,))))
+            while len(pending) > self.nprocs:
+                start, stop, i, res = pending.popleft()
+                out[start:stop, :, i] = res.get()
+        while len(pending) > 0:
+            start, stop, i, res = pending.popleft()
+            out[start:stop, :, i] = res.get()
 
+        return Image(img=img, nprocs=self.nprocs)
 
     def _calculate_median(self):
         '''Calculate the median of the stack and return the resulting
-        image with the original dtype.
+        image with the storage dtype, or as floating point for scaled
+        stacks.
         '''
-        ch_r = np.median(self.stack['R'], 2)
-        ch_g = np.median(self.stack['G'], 2)
-        ch_b = np.median(self.stack['B'], 2)
-        shape = ch_r.shape[:2]
-        img = np.empty((shape[0], shape[1], 3), dtype=self.stack['R'].dtype)
-        img[:, :, 0] = ch_r.astype(self.stack['R'].dtype)
-        img[:, :, 1] = ch_g.astype(self.stack['G'].dtype)
-        img[:, :, 2] = ch_b.astype(self.stack['B'].dtype)
+        def _worker(chan):
+            '''Calculate one channel of a tile.'''
+            return np.median(chan, 0)
 
-        return Image(img=img, nprocs=self.nprocs)
+        return self._map_deep(_worker)
 
     def _calculate_sigma(self):
         '''Calculate the sigma-reject average of the stack and return
-        the result as Image(dtype=uint16).
+        the resulting image with the storage dtype, or as floating
+        point for scaled stacks.
         '''
-        shape = self.stack['R'].shape
-        img = np.zeros((shape[0], shape[1], 3), dtype=self.stack['R'].dtype)
-
-        try:
-            kappa = self._kwargs["kappa"]
-        except (TypeError, KeyError):
-            kappa = 2.0
-        try:
-            max_iters = self._kwargs["max_iters"]
-        except (TypeError, KeyError):
-            max_iters = max(1, self._num/8)
+        kappa = self._get_kwarg('kappa', 2.0)
+        max_iters = self._get_kwarg('max_iters', max(1, self._num//8))
 
         LOGGER.info("Calculating Sigma-Kappa average.")
 
-        img[:, :, 0] = _sigma_worker(self.stack['R'], kappa, max_iters)
-        img[:, :, 1] = _sigma_worker(self.stack['G'], kappa, max_iters)
-        img[:, :, 2] = _sigma_worker(self.stack['B'], kappa, max_iters)
+        def _worker(chan):
+            '''Calculate one channel of a tile.'''
+            return _sigma_worker(chan, kappa, max_iters)
 
-        return Image(img=img, nprocs=self.nprocs)
+        return self._map_deep(_worker)
 
-def _sigma_worker(data, kappa, max_iters):
-    '''Calculate kappa-sigma mean of the data.'''
-
-    shape = data.shape
-    tile_shape = (shape[-1], 1)
-    data_out = np.empty((shape[0], shape[1]), dtype=STACK_DTYPE) # data.dtype)
-
-    for i in range(shape[0]):
-        num_it = 0
-        row = np.ma.masked_equal(data[i, :, :], 0).T
-        while True:
-            avgs = np.mean(row, 0)
-            diffs = np.abs(np.tile(avgs, tile_shape) - row)
-            stds = np.std(row, 0)
-            idxs = diffs > kappa * np.tile(stds, tile_shape)
-            num_it += 1
-            if np.any(idxs):
-                row = np.ma.masked_where(idxs, row)
+    def _map_deep(self, func):
+        '''Apply *func* to the channels of the deep stack tiles and
+        return the resulting image.  Results of scaled stacks are
+        scaled back to floating point values.
+        '''
+        if self._scale is None:
+            return self._map_tiles(func, self._deep_tiles(), self.stack.dtype)
+        img = self._map_tiles(func, self._deep_tiles(), STACK_DTYPE)
+        img.img /= self._scale
+
+        return img
+
+    def _update_approx_median(self, frame, weight=None):
+        '''Update approximate median stack.  Each pixel has a histogram
+        of its values, so the memory use doesn't depend on the number
+        of images.
+        '''
+        del weight
+        data = frame.data
+        if self.stack is None:
+            self._init_approx_median(data)
+
+        low, high = data.min(), data.max()
+        if low < self._hist_range[0] or high > self._hist_range[1]:
+            if self._get_kwarg('range') is None and \
+                    np.isfinite(low) and np.isfinite(high):
+                self._widen_hist_range(low, high)
             else:
-                break
-            if num_it >= max_iters:
-                break
-        data_out[i, :] = np.mean(row, 0)
+                LOGGER.warning("Values outside the range %.3f - %.3f are "
+                               "counted to the first or last bin of the "
+                               "approximate median.",
+                               self._hist_range[0], self._hist_range[1])
+
+        bins = self.stack.shape[-1]
+        scale = bins / float(self._hist_range[1] - self._hist_range[0])
+        idxs = ((data.ravel() - self._hist_range[0]) * scale).astype(np.int64)
+        np.clip(idxs, 0, bins - 1, out=idxs)
+        # Each pixel gets exactly one count, so there are no duplicate
+        # indices
+        idxs += np.arange(0, self.stack.size, bins)
+        self.stack.reshape(-1)[idxs] += 1
+
+    def _init_approx_median(self, data):
+        '''Create the pixel histograms of the approximate median stack
+        for images like *data*.
+        '''
+        self._img_shape = data.shape
+        if self.num < 2**8:
+            count_dtype = np.dtype(np.uint8)
+        elif self.num < 2**16:
+            count_dtype = np.dtype(np.uint16)
+        else:
+            count_dtype = np.dtype(np.uint32)
+        integer = np.issubdtype(data.dtype, np.integer)
+
+        bins = self._get_kwarg('bins')
+        if bins is None:
+            # Use at most as much memory as the images would take
+            bins = self.num * data.dtype.itemsize // count_dtype.itemsize
+            bins = min(max(bins, APPROX_MEDIAN_MIN_BINS),
+                       APPROX_MEDIAN_MAX_BINS)
+            if integer:
+                info = np.iinfo(data.dtype)
+                bins = min(bins, int(info.max) - int(info.min) + 1)
+        if bins * count_dtype.itemsize > self.num * data.dtype.itemsize:
+            LOGGER.warning("Approximate median with %d bins uses more "
+                           "memory than the median stack.", bins)
+
+        self._hist_range = self._get_kwarg('range')
+        if self._hist_range is None:
+            # Widening the range merges pairs of bins
+            bins += bins % 2
+            self._hist_range = _hist_range(data.min(), data.max(), bins,
+                                           integer)
+        LOGGER.debug("Using %d bins between %.3f and %.3f.", bins,
+                     self._hist_range[0], self._hist_range[1])
+        self.stack = np.zeros(self._img_shape[:2] + (self._chans(), bins),
+                              dtype=count_dtype)
+
+    def _widen_hist_range(self, low, high):
+        '''Double the range of the approximate median histograms until
+        values from *low* to *high* fit in it.  Adjacent pairs of bins
+        are merged, so the counts stay exact but the bins get twice as
+        wide.
+        '''
+        bins = self.stack.shape[-1]
+        half = bins // 2
+        range_low, range_high = self._hist_range
+        tile_rows = _tile_rows(self.stack[0])
+        while low < range_low or high > range_high:
+            width = range_high - range_low
+            if high > range_high:
+                range_high += width
+                merged, emptied = slice(None, half), slice(half, None)
+            else:
+                range_low -= width
+                merged, emptied = slice(half, None), slice(None, half)
+            for start in range(0, self._img_shape[0], tile_rows):
+                tile = self.stack[start:start+tile_rows]
+                tile[..., merged] = tile[..., 0::2] + tile[..., 1::2]
+                tile[..., emptied] = 0
+        LOGGER.debug("Widened approximate median range to %.3f - %.3f.",
+                     range_low, range_high)
+        self._hist_range = (range_low, range_high)
+
+    def _calculate_approx_median(self):
+        '''Calculate the approximate median from the pixel histograms
+        and return the resulting image.  The median is interpolated
+        linearly within the bin where it falls in.
+        '''
+        bins = self.stack.shape[-1]
+        width = (self._hist_range[1] - self._hist_range[0]) / float(bins)
+        half = self._num / 2.
+
+        def _worker(hist):
+            '''Calculate one channel of a tile.'''
+            shape = hist.shape[:-1]
+            hist = hist.reshape((-1, bins))
+            cumsum = np.cumsum(hist, -1, dtype=np.uint32)
+            idxs = np.sum(cumsum < half, -1)
+            np.clip(idxs, 0, bins - 1, out=idxs)
+            pixels = np.arange(hist.shape[0])
+            in_bin = hist[pixels, idxs].astype(STACK_DTYPE)
+            below = cumsum[pixels, idxs] - in_bin
+            in_bin[in_bin == 0] = 1
+            return (self._hist_range[0] +
+                    (idxs + (half - below) / in_bin) * width).reshape(shape)
+
+        def _tiles():
+            '''Iterate over tiles of the histograms.'''
+            tile_rows = self._task_rows(self.stack[0, :, 0],
+                                        self._img_shape[0])
+            for start in range(0, self._img_shape[0], tile_rows):
+                stop = min(start + tile_rows, self._img_shape[0])
+                yield (start, stop, [self.stack[start:stop, :, i]
+                                     for i in range(self._chans())])
+
+        return self._map_tiles(_worker, _tiles(), STACK_DTYPE)
+
+class StackSet(object):
+    '''Set of stacks that are updated with the same images.  Data
+    needed by several stacks, such as luminance or conversion to
+    floating point, is calculated only once for each image.
+
+    :param stacks: stacks in the set
+    :type stacks: list of halostack.stack.Stack or None
+    '''
+
+    def __init__(self, stacks=None):
+        self.stacks = []
+        if stacks is not None:
+            self.stacks = list(stacks)
+
+    def __iter__(self):
+        return iter(self.stacks)
+
+    def __len__(self):
+        return len(self.stacks)
+
+    def append(self, stack):
+        '''Add a stack to the set.
+
+        :param stack: stack to add
+        :type stack: halostack.stack.Stack
+        '''
+        self.stacks.append(stack)
+
+    def add_image(self, img, weight=None):
+        '''Add a frame to all the stacks.
+
+        :param img: image to be added to the stacks
+        :type img: halostack.image.Image
+        :param weight: weight of the image, used only by the weighted
+                       average stacks [1.0]
+        :type weight: float or None
+        '''
+        frame = _Frame(img)
+        for stack in self.stacks:
+            stack.add_image(frame, weight=weight)
+
+    def calculate(self):
+        '''Calculate the results of all the stacks.
+
+        :rtype: list of halostack.image.Image
+        '''
+        return [stack.calculate() for stack in self.stacks]
+
+class _Frame(object):
+    '''Data of an image added to the stacks.  Derived data are
+    calculated when first needed and shared by all the stacks.
+    '''
+
+    def __init__(self, img):
+        if not isinstance(img, np.ndarray):
+            if not isinstance(img, Image):
+                img = Image(img=img)
+            img = img[...]
+        self.data = img
+        self._luminance = None
+        self._converted = {}
+
+    def __getitem__(self, idx):
+        return self.data[idx]
+
+    def luminance(self):
+        '''Return luminance (channel average) of the image.
+        '''
+        if self._luminance is None:
+            self._luminance = _luminance(self.data)
+        return self._luminance
+
+    def astype(self, dtype, scale=None):
+        '''Return the image data, multiplied by *scale* if given,
+        converted to *dtype*.
+        '''
+        key = (np.dtype(dtype), scale)
+        if key not in self._converted:
+            data = self.data
+            if scale is not None:
+                data = data * scale
+            self._converted[key] = _to_dtype(data, key[0])
+        return self._converted[key]
+
+def _to_dtype(data, dtype):
+    '''Convert *data* to *dtype*.  Floating point data are rounded,
+    and data not fitting in integer *dtype* are clipped to its range.
+    '''
+    if data.dtype == dtype:
+        return data
+    if np.issubdtype(dtype, np.integer) and not np.can_cast(data.dtype,
+                                                            dtype):
+        info = np.iinfo(dtype)
+        if not np.issubdtype(data.dtype, np.integer):
+            data = np.round(data)
+        data = np.clip(data, info.min, info.max)
+    return data.astype(dtype)
+
+def _luminance(data):
+    '''Return luminance (channel average) of image data.
+    '''
+    if data.ndim > 2:
+        return np.mean(data, 2)
+    return data
+
+def _hist_range(low, high, bins, integer):
+    '''Return histogram range (min, max) of *bins* bins covering the
+    values from *low* to *high*.  For integer data the bins are
+    centered on integer values and the bin width is a whole number of
+    values.
+    '''
+    if not integer:
+        low, high = float(low), float(high)
+        if high <= low:
+            high = low + 1.
+        return (low, high)
+
+    low, high = int(low), int(high)
+    width = max(1, -(-(high - low + 1) // bins))
+    while (low // width + bins) * width <= high:
+        width += 1
+    start = low // width * width
+
+    return (start - 0.5, start + bins * width - 0.5)
+
+def _tile_rows(row):
+    '''Return the number of rows in a tile, when *row* is the data of
+    one image row.
+    '''
+    return int(max(1, TILE_BYTES // max(1, row.nbytes)))
+
+def _sigma_worker(data, kappa, max_iters):
+    '''Calculate kappa-sigma mean of the data.  The *data* is a
+    (images, rows, columns) array where zero values are treated as
+    missing data.  Sums of the accepted values and their squares are
+    kept for each pixel, and the rejected values are subtracted from
+    them on each iteration, so no masked arrays are needed.  The
+    temporary arrays of the data size are allocated once and reused on
+    every iteration.  Pixels without any accepted values are set to
+    zero.
+    '''
+    valid = np.not_equal(data, 0)
+    rejected = np.empty(data.shape, dtype=np.bool_)
+    work = np.empty(data.shape, dtype=STACK_DTYPE)
+
+    num = np.sum(valid, 0, dtype=STACK_DTYPE)
+    sum1 = np.sum(data, 0, dtype=STACK_DTYPE)
+    np.square(data, out=work, dtype=STACK_DTYPE)
+    sum2 = np.sum(work, 0)
+
+    for _ in range(max_iters):
+        avgs, stds = _sigma_stats(sum1, sum2, num)
+        np.subtract(data, avgs, out=work, dtype=STACK_DTYPE)
+        np.abs(work, out=work)
+        stds *= kappa
+        np.greater(work, stds, out=rejected)
+        rejected &= valid
+        if not np.any(rejected):
+            break
+        # Rejected values are a subset of the valid ones
+        np.logical_xor(valid, rejected, out=valid)
+        num -= np.sum(rejected, 0)
+        work.fill(0)
+        np.copyto(work, data, where=rejected)
+        sum1 -= np.sum(work, 0)
+        np.square(work, out=work)
+        sum2 -= np.sum(work, 0)
+
+    return _sigma_stats(sum1, sum2, num)[0]
+
+def _sigma_stats(sum1, sum2, num):
+    '''Calculate mean and standard deviation from sums of values and
+    squared values.  Pixels without data get zero mean and deviation.
+    '''
+    denom = np.where(num > 0, num, 1)
+    avgs = sum1 / denom
+    stds = np.sqrt(np.maximum(sum2 / denom - avgs**2, 0))
 
-    return data_out
+    return avgs, stds
@@ -29,6 +29,7 @@ from . import test_helpers
 from . import test_image
 from . import test_align
 from . import test_stack
+from . import test_pool
 from . import test_halostack
 
 def suite():
@@ -40,6 +41,7 @@ def suite():
     mysuite.addTests(test_image.suite())
     mysuite.addTests(test_align.suite())
     mysuite.addTests(test_stack.suite())
+    mysuite.addTests(test_pool.suite())
     mysuite.addTests(test_halostack.suite())
     
     return mysuite
@@ -1,6 +1,9 @@
 import unittest
 import os
-from halostack.align import Align
+from halostack.align import Align, AlignCache, select_reference, \
+    _window_sums
+from halostack.helpers import warp
+import tempfile
 import numpy as np
 
 class TestAlign(unittest.TestCase):
@@ -27,6 +30,155 @@ class TestAlign(unittest.TestCase):
         result = self.align._simple_match(img)
         self.assertItemsEqual(result, correct_result)
 
+    def test_fft_match(self):
+        align = Align(self.img, mode='fft', nprocs=1)
+        align.set_reference((15, 15, 2))
+        align.set_search_area([0, 0, 31, 31])
+        # image to be matched
+        img = np.zeros((31, 31, 3))
+        img[12, 12, :] = 1
+        img[5, 20, :] = 0.5
+        # correlation, x-location, y-location
+        result = align._fft_match(img)
+        self.assertAlmostEqual(result[0], 1.0)
+        self.assertEqual(result[1], 12)
+        self.assertEqual(result[2], 12)
+
+    def test_fft_match_smooth(self):
+        # smooth, band-limited texture like a sky with halos
+        np.random.seed(3)
+        noise = np.fft.rfft2(np.random.random((120, 160)))
+        freqs = np.hypot(np.fft.fftfreq(120)[:, np.newaxis],
+                         np.fft.rfftfreq(160)[np.newaxis, :])
+        img = np.fft.irfft2(noise * np.exp(-(freqs / 0.03)**2),
+                            s=(120, 160))
+        img = np.dstack((img, img, 2*img)) + 10
+        for x_shift, y_shift in ((0, 0), (7, -5), (-12, 9)):
+            align = Align(img, mode='fft', nprocs=1)
+            align.set_reference((80, 60, 15))
+            align.set_search_area((80, 60, 25))
+            img2 = np.roll(np.roll(img, y_shift, 0), x_shift, 1)
+            result = align._fft_match(img2)
+            self.assertTrue(result[0] > 0.99)
+            self.assertEqual(result[1], 80 + x_shift)
+            self.assertEqual(result[2], 60 + y_shift)
+
+    def test_align_cache(self):
+        y_locs, x_locs = np.mgrid[0:60, 0:60]
+        img = np.zeros((60, 60, 3))
+        for y_c, x_c, sigma in [(30, 30, 3), (25, 35, 2)]:
+            img += np.exp(-((y_locs-y_c)**2 + (x_locs-x_c)**2) /
+                          (2. * sigma**2))[:, :, np.newaxis]
+        img2 = np.roll(np.roll(img, 3, 0), -2, 1)
+        fid, fname = tempfile.mkstemp(suffix='.json')
+        os.close(fid)
+        os.remove(fname)
+        try:
+            cache = AlignCache(fname)
+            align = Align(img, mode='simple', cache=cache, cor_th=0.5)
+            align.set_reference((30, 30, 8))
+            align.set_search_area((30, 30, 10))
+            result = align.align(img2)
+            self.assertEqual(align.correlation, 1.0)
+            cache.save()
+            self.assertTrue(os.path.exists(fname))
+
+            cache = AlignCache(fname)
+            align.cache = cache
+            key = cache.key(img2, align._cache_settings())
+            self.assertEqual(cache.get(key)['x'], 28)
+            self.assertEqual(cache.get(key)['y'], 33)
+            # Fake result to check that the cache is used
+            cache.put(key, {'correlation': 0.9, 'x': 29, 'y': 33,
+                            'angle': 0.})
+            result2 = align.align(img2)
+            self.assertEqual(align.correlation, 0.9)
+            self.assertTrue(np.all(result2[:, :-1] == result[:, 1:]))
+            # Different settings don't use the cached result
+            align.subpixel = True
+            self.assertTrue(cache.get(
+                cache.key(img2, align._cache_settings())) is None)
+        finally:
+            if os.path.exists(fname):
+                os.remove(fname)
+
+    def test_select_reference(self):
+        img = np.zeros((40, 50, 3))
+        img[10, 12, :] = 1
+        # Checkerboard has the highest variance
+        y_locs, x_locs = np.mgrid[0:5, 0:5]
+        img[28:33, 34:39, :] = (-1.)**(y_locs + x_locs)[:, :, np.newaxis]
+        self.assertEqual(select_reference(img, 2), [36, 30, 2])
+        self.assertEqual(select_reference(img[:, :, 0], 2), [36, 30, 2])
+        result = select_reference(img, 2, area=(12, 10, 5))
+        self.assertEqual(result[2], 2)
+        self.assertTrue(abs(result[0] - 12) <= 2)
+        self.assertTrue(abs(result[1] - 10) <= 2)
+        # No reference fits in the area or in the image
+        self.assertRaises(ValueError, select_reference, img, 2, (0, 0, 1))
+        self.assertRaises(ValueError, select_reference, img, 30)
+
+    def test_pyramid_match(self):
+        # reference image with a few gaussian blobs
+        y_locs, x_locs = np.mgrid[0:100, 0:100]
+        img = np.zeros((100, 100, 3))
+        for y_c, x_c, sigma in [(40, 50, 3), (55, 45, 5), (50, 60, 2)]:
+            img += np.exp(-((y_locs-y_c)**2 + (x_locs-x_c)**2) /
+                          (2. * sigma**2))[:, :, np.newaxis]
+        align = Align(img, mode='pyramid', nprocs=1)
+        align.set_reference((50, 50, 12))
+        align.set_search_area((50, 50, 30))
+        self.assertEqual(len(align._ref_pyramid), 2)
+        # image to be matched
+        ref_img = img
+        img = np.roll(np.roll(img, 7, 0), -5, 1)
+        # correlation, x-location, y-location
+        result = align._pyramid_match(img)
+        self.assertAlmostEqual(result[0], 1.0)
+        self.assertEqual(result[1], 45)
+        self.assertEqual(result[2], 57)
+
+        # same result with the references shared to worker processes
+        align2 = Align(ref_img, mode='pyramid', nprocs=2)
+        align2.set_reference((50, 50, 12))
+        align2.set_search_area((50, 50, 30))
+        self.assertEqual(len(align2._shared_refs), 3)
+        names = [shared.name for shared in align2._shared_refs]
+        self.assertEqual(list(align2._pyramid_match(img)[1:]), [45, 57])
+        align2.close()
+        for name in names:
+            self.assertFalse(os.path.exists(name))
+
+    def test_rotation_match(self):
+        # reference image with asymmetric set of gaussian blobs
+        y_locs, x_locs = np.mgrid[0:80, 0:80]
+        img = np.zeros((80, 80, 3))
+        for y_c, x_c, sigma in [(40, 40, 3), (30, 45, 2), (48, 50, 4),
+                                (35, 28, 2), (52, 33, 3)]:
+            img += np.exp(-((y_locs-y_c)**2 + (x_locs-x_c)**2) /
+                          (2. * sigma**2))[:, :, np.newaxis]
+        align = Align(img, mode='rotation', nprocs=1)
+        align.set_reference((40, 40, 16))
+        align.set_search_area((40, 40, 8))
+        # rotate the reference area by 8 degrees clockwise and move it
+        # to (42, 37)
+        img2 = np.zeros(img.shape)
+        warp(img, img2, (40, 40), (42, 37), np.radians(8))
+        result = align._rotation_match(img2)
+        self.assertTrue(result[0] > 0.99)
+        self.assertAlmostEqual(result[1], 42, 0)
+        self.assertAlmostEqual(result[2], 37, 0)
+        self.assertAlmostEqual(np.degrees(align.angle), -8, 0)
+
+    def test_window_sums(self):
+        data = np.arange(20.).reshape((4, 5))
+        result = _window_sums(data, (2, 3))
+        self.assertEqual(result.shape, (3, 3))
+        for i in range(3):
+            for j in range(3):
+                self.assertAlmostEqual(result[i, j],
+                                       np.sum(data[i:i+2, j:j+3]))
+
 
     def test_calc_shift(self):
         result = self.align._calc_shift(10, 10)
@@ -46,6 +198,25 @@ class TestAlign(unittest.TestCase):
         correct_result[12, 17, :] = 1
         self.assertTrue(np.allclose(img2, correct_result))
 
+    def test_subpixel_shift(self):
+        img2 = self.align._shift(self.img, 0.5, -0.25)
+        correct_result = np.zeros((31, 31, 3))
+        correct_result[15, 15, :] = 0.375
+        correct_result[15, 16, :] = 0.375
+        correct_result[14, 15, :] = 0.125
+        correct_result[14, 16, :] = 0.125
+        self.assertTrue(np.allclose(img2, correct_result))
+
+    def test_refine_location(self):
+        y_locs, x_locs = np.mgrid[0:31, 0:31]
+        img = np.exp(-((y_locs-15)**2 + (x_locs-15)**2) / 8.)
+        align = Align(img[:, :, np.newaxis], subpixel=True)
+        align.set_reference((15, 15, 5))
+        img = np.exp(-((y_locs-13.8)**2 + (x_locs-16.3)**2) / 8.)
+        x_loc, y_loc = align._refine_location(img[:, :, np.newaxis], 16, 14)
+        self.assertAlmostEqual(x_loc, 16.3, 1)
+        self.assertAlmostEqual(y_loc, 13.8, 1)
+
 
 def suite():
     """The suite for test_align
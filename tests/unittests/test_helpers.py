@@ -1,8 +1,11 @@
 import unittest
 import os
 from halostack.helpers import get_filenames, parse_enhancements, \
-    intermediate_fname
+    intermediate_fname, prefetch, parse_area, bilinear_sample
+import numpy as np
 import platform
+import random
+import time
 
 class TestHelpers(unittest.TestCase):
     
@@ -51,6 +54,41 @@ class TestHelpers(unittest.TestCase):
             result = intermediate_fname('foo', '/tmp/bar/img.png')
             self.assertEqual(result, '/tmp/bar/foo_img.png')
 
+    def test_parse_area(self):
+        self.assertEqual(parse_area('10,20,5'), [10, 20, 5])
+        self.assertEqual(parse_area((10, 20, 5)), [10, 20, 5])
+        self.assertTrue(parse_area(None) is None)
+        self.assertRaises(ValueError, parse_area, '10,20')
+
+    def test_prefetch(self):
+        def _func(item):
+            time.sleep(random.random() / 100.)
+            return 2 * item
+
+        for depth in (0, 1, 3):
+            result = list(prefetch(_func, range(10), depth=depth))
+            self.assertItemsEqual(result, [2 * i for i in range(10)])
+
+        # Items are read only *depth* items ahead
+        read = []
+        def _items():
+            for i in range(10):
+                read.append(i)
+                yield i
+        gen = prefetch(_func, _items(), depth=2)
+        self.assertEqual(next(gen), 0)
+        self.assertEqual(len(read), 3)
+        gen.close()
+
+        def _fail(item):
+            if item == 2:
+                raise ValueError
+            return item
+        gen = prefetch(_fail, range(5), depth=2)
+        self.assertEqual(next(gen), 0)
+        self.assertEqual(next(gen), 1)
+        self.assertRaises(ValueError, next, gen)
+
     def assertItemsEqual(self, a, b):
         for i in range(len(a)):
             if isinstance(a[i], dict):
@@ -59,6 +97,27 @@ class TestHelpers(unittest.TestCase):
                 self.assertEqual(a[i], b[i])
         self.assertEqual(len(a), len(b))
 
+    def test_bilinear_sample(self):
+        data = np.arange(12.).reshape((3, 4))
+        out = np.empty(3)
+        bilinear_sample(data, np.array([0.5, 1., 5.]),
+                        np.array([1.5, 3., 0.]), out)
+        self.assertAlmostEqual(out[0], 3.5)
+        self.assertAlmostEqual(out[1], 7.)
+        self.assertEqual(out[2], 0)
+
+        # single row and single column data
+        bilinear_sample(data[:1, :], np.array([0., 0., 0.5]),
+                        np.array([0.5, 3., 1.]), out)
+        self.assertAlmostEqual(out[0], 0.5)
+        self.assertAlmostEqual(out[1], 3.)
+        self.assertEqual(out[2], 0)
+        bilinear_sample(data[:, :1], np.array([1.5, 0., 1.]),
+                        np.array([0., 0., 0.]), out)
+        self.assertAlmostEqual(out[0], 6.)
+        self.assertAlmostEqual(out[1], 0.)
+        self.assertAlmostEqual(out[2], 4.)
+
     def assertDictEqual(self, a, b):
         for key in a:
             self.assertTrue(key in b)
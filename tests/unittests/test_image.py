@@ -1,7 +1,14 @@
 import unittest
 import os
-from halostack.image import Image, _scale
+from halostack.image import Image, _scale, register_reader, READERS, \
+    AsyncWriter, FrameCache
+import shutil
+import struct
+import tempfile
+import threading
+import zlib
 import numpy as np
+from halostack import image
 
 class TestImage(unittest.TestCase):
     
@@ -23,6 +30,221 @@ class TestImage(unittest.TestCase):
         self.img_rand_neg = Image(img=np.random.randint(-100, 100,
                                                          size=(3, 3, 3)))
 
+    def test_read(self):
+        def _reader(fname):
+            if 'fail' in fname:
+                raise IOError
+            if 'none' in fname:
+                return None
+            return np.zeros((4, 5), dtype=np.uint16)
+        def _reader2(fname):
+            return np.ones((4, 5, 3), dtype=np.uint8)
+
+        readers = list(READERS)
+        try:
+            register_reader(('.foo', '.bar'), _reader2)
+            register_reader(('.foo',), _reader)
+            img = Image(fname='image.FOO')
+            self.assertEqual(img.shape, (4, 5, 1))
+            self.assertEqual(img.img.dtype, np.uint16)
+            img = Image(fname='image.bar')
+            self.assertEqual(img.shape, (4, 5, 3))
+            self.assertEqual(img.img.max(), 1)
+            for fname in ('fail.foo', 'none.foo'):
+                img = Image(fname=fname)
+                self.assertEqual(img.img.max(), 1)
+        finally:
+            READERS[:] = readers
+        self.assertEqual(Image(img=np.zeros((2, 3))).shape, (2, 3))
+
+    def test_save_png(self):
+        fid, fname = tempfile.mkstemp(suffix='.png')
+        os.close(fid)
+        try:
+            data = np.arange(24, dtype=np.float).reshape((2, 4, 3))
+            img = Image(img=data.copy())
+            img.save(fname, bits=16, compression=9)
+            self.assertItemsEqual(img.img, data)
+            with open(fname, 'rb') as fid:
+                png = fid.read()
+            self.assertEqual(png[:8], b'\x89PNG\r\n\x1a\n')
+            self.assertEqual(png[12:16], b'IHDR')
+            self.assertEqual(struct.unpack('>IIBB', png[16:26]),
+                             (4, 2, 16, 2))
+            length = struct.unpack('>I', png[33:37])[0]
+            self.assertEqual(png[37:41], b'IDAT')
+            raw = np.frombuffer(zlib.decompress(png[41:41+length]),
+                                dtype=np.uint8).reshape((2, -1))
+            result = _png_unfilter(raw, 6).view('>u2').reshape((2, 4, 3))
+            self.assertItemsEqual(result, _scale(data, bits=16))
+            self.assertEqual(png[-8:-4], b'IEND')
+
+            Image(img=np.zeros((5, 6), dtype=np.uint8)).save(fname, bits=8)
+            with open(fname, 'rb') as fid:
+                png = fid.read()
+            self.assertEqual(struct.unpack('>IIBB', png[16:26]),
+                             (6, 5, 8, 0))
+
+            # All filter types, and data with more than 16 bits
+            data = np.random.randint(0, 2**20, (40, 30, 3)).astype(np.uint32)
+            data[:10] = np.arange(30)[:, np.newaxis]
+            data[10:20] = np.arange(10, 20)[:, np.newaxis, np.newaxis]
+            self.assertTrue(image._write_png(fname, data, 6))
+            with open(fname, 'rb') as fid:
+                png = fid.read()
+            self.assertEqual(struct.unpack('>IIBB', png[16:26]),
+                             (30, 40, 16, 2))
+            length = struct.unpack('>I', png[33:37])[0]
+            raw = np.frombuffer(zlib.decompress(png[41:41+length]),
+                                dtype=np.uint8).reshape((40, -1))
+            self.assertTrue(len(set(raw[:, 0])) > 1)
+            result = _png_unfilter(raw, 6).view('>u2').reshape((40, 30, 3))
+            self.assertItemsEqual(result, _scale(data, bits=16))
+        finally:
+            os.remove(fname)
+
+    def test_read_pillow(self):
+        calls = []
+
+        class _Image(object):
+            '''Image opened by Pillow'''
+            mode = 'L'
+
+            def __array__(self, dtype=None):
+                return np.zeros((5, 6), dtype=np.uint8)
+
+        class _Pillow(object):
+            '''Pillow Image module'''
+            @staticmethod
+            def open(fname):
+                calls.append(fname)
+                return _Image()
+
+        fid, fname = tempfile.mkstemp(suffix='.png')
+        os.close(fid)
+        orig = image.PILImage
+        try:
+            image.PILImage = _Pillow()
+            # 16-bit PNG images are left to other readers
+            image._write_png(fname, np.zeros((5, 6, 3), dtype=np.uint16), 6)
+            self.assertEqual(image._png_bit_depth(fname), 16)
+            self.assertTrue(image._read_pillow(fname) is None)
+            self.assertEqual(calls, [])
+            image._write_png(fname, np.zeros((5, 6), dtype=np.uint8), 6)
+            self.assertEqual(image._png_bit_depth(fname), 8)
+            self.assertEqual(image._read_pillow(fname).shape, (5, 6))
+            self.assertEqual(calls, [fname])
+            with open(fname, 'wb') as fid:
+                fid.write(b'\xff\xd8 not a PNG')
+            self.assertEqual(image._png_bit_depth(fname), 0)
+        finally:
+            image.PILImage = orig
+            os.remove(fname)
+
+    def test_write_tifffile(self):
+        calls = []
+
+        class _Tifffile(object):
+            '''tifffile versions with only the given keywords'''
+            def __init__(self, keywords):
+                self.keywords = keywords
+
+            def imwrite(self, fname, img, **kwargs):
+                if not set(kwargs).issubset(self.keywords):
+                    raise TypeError("unexpected keyword")
+                calls.append(kwargs)
+
+        data = np.zeros((2, 3, 1), dtype=np.uint16)
+        orig = image.tifffile
+        try:
+            for keywords in (('compression', 'compressionargs'),
+                             ('compression',), ('compress',)):
+                image.tifffile = _Tifffile(keywords)
+                self.assertTrue(image._write_tifffile('x.tif', data, 6))
+            image._write_tifffile('x.tif', data, 0)
+        finally:
+            image.tifffile = orig
+        self.assertEqual(calls, [{'compression': 'zlib',
+                                  'compressionargs': {'level': 6}},
+                                 {'compression': ('zlib', 6)},
+                                 {'compress': 6}, {}])
+
+    def test_async_writer(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            data = np.arange(12, dtype=np.uint8).reshape((3, 4))
+            img = Image(img=data.copy())
+            with AsyncWriter(threads=2, queue_size=1) as writer:
+                for i in range(5):
+                    writer.save(img, os.path.join(tmpdir, '%d.png' % i),
+                                bits=8)
+                    # The image can be modified after submitting
+                    img.img[:] = 0
+                writer.flush()
+                self.assertEqual(len(os.listdir(tmpdir)), 5)
+            self.assertRaises(ValueError, writer.save, img, 'foo.png')
+
+            writer = AsyncWriter()
+            writer.save(img, os.path.join(tmpdir, 'nodir', 'x.png'))
+            self.assertRaises(IOError, writer.close)
+        finally:
+            for fname in os.listdir(tmpdir):
+                os.remove(os.path.join(tmpdir, fname))
+            os.rmdir(tmpdir)
+
+    def test_frame_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        calls = []
+        def _reader(fname):
+            calls.append(fname)
+            return np.zeros((10, 10, 3), dtype=np.uint16) + len(calls)
+
+        readers = list(READERS)
+        fnames = [os.path.join(tmpdir, '%d.foo' % i) for i in range(3)]
+        try:
+            for fname in fnames:
+                with open(fname, 'w') as fid:
+                    fid.write(fname)
+            register_reader(('.foo',), _reader)
+            cache = FrameCache(os.path.join(tmpdir, 'cache'),
+                               max_size=1500)
+            img = Image(fname=fnames[0], cache=cache)
+            self.assertEqual(len(calls), 1)
+            img = Image(fname=fnames[0], cache=cache)
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(img.shape, (10, 10, 3))
+            self.assertEqual(img.img.max(), 1)
+            # Copy-on-write
+            img.img[:] = 5
+            img = Image(fname=fnames[0], cache=cache)
+            self.assertEqual(img.img.max(), 1)
+            # The oldest image is removed
+            os.utime(cache._path(fnames[0]), (1, 1))
+            Image(fname=fnames[1], cache=cache)
+            Image(fname=fnames[2], cache=cache)
+            self.assertEqual(len(os.listdir(cache.directory)), 2)
+            self.assertTrue(cache.get(fnames[0]) is None)
+            self.assertEqual(cache.get(fnames[2]).max(), 3)
+
+            # Files removed by others are skipped
+            os.symlink(os.path.join(tmpdir, 'none.npy'),
+                       os.path.join(cache.directory, 'gone.npy'))
+            cache.put(fnames[0], np.zeros((10, 10, 3), dtype=np.uint16))
+            os.remove(os.path.join(cache.directory, 'gone.npy'))
+            # Concurrent use from several threads
+            threads = [threading.Thread(target=cache.put,
+                                        args=(fnames[i % 3],
+                                              np.zeros((10, 10, 3))))
+                       for i in range(12)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertTrue(len(os.listdir(cache.directory)) <= 2)
+        finally:
+            READERS[:] = readers
+            shutil.rmtree(tmpdir)
+
     def test_add(self):
         result = self.img1 + self.img2
         correct_result = np.ones((3, 3))
@@ -137,6 +359,33 @@ class TestImage(unittest.TestCase):
         correct_result[:, :, 2] = 2
         self.assertItemsEqual(correct_result, img.img)
 
+    def test_blur(self):
+        # symmetric kernel keeps a linear ramp intact away from the edges
+        ramp = np.tile(np.arange(40.), (30, 1))
+        for radius in [3, 12]:
+            img = Image(img=np.dstack((ramp, ramp, 2*ramp)))
+            img._blur([radius])
+            diffs = np.diff(img.img[:, 2*radius:-2*radius, :], axis=1)
+            self.assertTrue(np.allclose(diffs[:, :, :2], 1))
+            self.assertTrue(np.allclose(diffs[:, :, 2], 2))
+            self.assertEqual(img.min(), 0)
+
+        # integer data gives the same result with and without workers
+        data = np.random.randint(0, 2**16, (30, 40, 3)).astype(np.uint16)
+        img = Image(img=data.copy())
+        img._blur([4])
+        img2 = Image(img=data.copy(), nprocs=2)
+        img2._blur([4])
+        self.assertTrue(np.all(img.img == img2.img))
+
+    def test_rotate(self):
+        img = Image(img=np.zeros((5, 5)))
+        img[2, 4] = 1
+        img._rotate(90)
+        correct_result = np.zeros((5, 5))
+        correct_result[0, 2] = 1
+        self.assertTrue(np.allclose(img.img, correct_result))
+
     def test_scale_values(self):
         self.img_rand8.img = _scale(self.img_rand8.img, 8)
         self.assertTrue(self.img_rand8.img.dtype == 'uint8')
@@ -170,6 +419,24 @@ class TestImage(unittest.TestCase):
                 self.assertEqual(a[i], b[i])
             self.assertEqual(len(a), len(b))
 
+def _png_unfilter(raw, bpp):
+    """Reverse the PNG row filters.
+    """
+    rows = np.zeros((raw.shape[0] + 1, raw.shape[1] - 1 + bpp), dtype=int)
+    for i in range(raw.shape[0]):
+        for j in range(bpp, rows.shape[1]):
+            left, upper = rows[i+1, j-bpp], rows[i, j]
+            upper_left = rows[i, j-bpp]
+            if raw[i, 0] < 4:
+                pred = [0, left, upper, (left + upper) // 2][raw[i, 0]]
+            else:
+                dists = [abs(upper - upper_left), abs(left - upper_left),
+                         abs(left + upper - 2 * upper_left)]
+                pred = [left, upper, upper_left][dists.index(min(dists))]
+            rows[i+1, j] = (raw[i, j-bpp+1] + pred) % 256
+
+    return rows[1:, bpp:].astype(np.uint8)
+
 def suite():
     """The suite for test_image
     """
@@ -0,0 +1,70 @@
+import unittest
+import os
+import numpy as np
+from halostack import pool
+
+class TestPool(unittest.TestCase):
+
+    def tearDown(self):
+        pool.shutdown()
+
+    def test_get_pool(self):
+        self.assertTrue(pool.get_pool(1) is None)
+        pool1 = pool.get_pool(2)
+        self.assertTrue(pool1 is not None)
+        self.assertTrue(pool.get_pool(2) is pool1)
+        self.assertTrue(pool.get_pool(1) is None)
+        self.assertEqual(pool1.map(abs, [-1, -2, 3]), [1, 2, 3])
+        pool2 = pool.get_pool(3)
+        self.assertTrue(pool2 is not pool1)
+        self.assertTrue(pool.get_pool(2) is pool2)
+
+    def test_get_thread_pool(self):
+        self.assertTrue(pool.get_thread_pool(1) is None)
+        pool1 = pool.get_thread_pool(2)
+        self.assertTrue(pool1 is not None)
+        self.assertTrue(pool.get_thread_pool(2) is pool1)
+        self.assertTrue(pool.get_pool(2) is not pool1)
+        self.assertEqual(pool1.map(abs, [-1, -2, 3]), [1, 2, 3])
+        pool2 = pool.get_thread_pool(3)
+        self.assertTrue(pool2 is not pool1)
+        self.assertTrue(pool.get_thread_pool(2) is pool2)
+
+    def test_shutdown(self):
+        pool1 = pool.get_pool(2)
+        thread_pool = pool.get_thread_pool(2)
+        pool.shutdown()
+        self.assertTrue(pool.get_pool(2) is not pool1)
+        self.assertTrue(pool.get_thread_pool(2) is not thread_pool)
+        pool.shutdown()
+        pool.shutdown()
+
+    def test_worker_pool(self):
+        with pool.worker_pool(2) as pool1:
+            self.assertTrue(pool.get_pool(2) is pool1)
+        self.assertTrue(pool.get_pool(2) is not pool1)
+
+    def test_shared_array(self):
+        data = np.arange(12.).reshape((3, 4))
+        with pool.SharedArray(data) as shared:
+            self.assertTrue(os.path.exists(shared.name))
+            arr = pool.attach(shared.spec())
+            self.assertTrue(np.all(arr == data))
+            arr[1, :] = 0
+            self.assertTrue(np.all(shared.array[1, :] == 0))
+            self.assertEqual(pool.attach(shared.spec(), mode='r')[2, 3], 11)
+            name = shared.name
+            del arr
+        self.assertFalse(os.path.exists(name))
+        shared = pool.SharedArray(data, dtype=np.uint8)
+        self.assertEqual(shared.array.dtype, np.uint8)
+        shared.close()
+        shared.close()
+
+
+def suite():
+    """The suite for test_pool
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestPool))
@@ -1,7 +1,7 @@
 import unittest
 import os
 from halostack.image import Image, _scale
-from halostack.stack import Stack
+from halostack.stack import Stack, StackSet, _Frame, _sigma_worker
 import numpy as np
 
 class TestStack(unittest.TestCase):
@@ -41,6 +41,33 @@ class TestStack(unittest.TestCase):
         correct_result = np.zeros((3, 3, 3), dtype=np.uint8)+1
         self.assertItemsEqual(stack.stack.img, correct_result)
 
+    def test_min_max_update(self):
+        img = np.zeros((2, 3, 3), dtype=np.uint8) + 5
+        # Only column 0 is brighter
+        img2 = img.copy()
+        img2[1, 0, :] = 9
+        img2[0, 2, :] = 1
+        min_stack = Stack('min', 2)
+        max_stack = Stack('max', 2)
+        base = Image(img=img)
+        min_stack.add_image(base)
+        max_stack.add_image(base)
+        min_stack.add_image(img2)
+        max_stack.add_image(img2)
+        self.assertEqual(max_stack.stack.img[1, 0, 0], 9)
+        self.assertEqual(max_stack.stack.img[0, 2, 0], 5)
+        self.assertEqual(min_stack.stack.img[1, 0, 0], 5)
+        self.assertEqual(min_stack.stack.img[0, 2, 0], 1)
+        self.assertEqual(max_stack._luminance[1, 0], 9)
+        self.assertItemsEqual(img, 5 * np.ones((2, 3, 3), dtype=np.uint8))
+
+        # Grayscale images
+        stack = Stack('max', 2)
+        stack.add_image(img[:, :, 0])
+        stack.add_image(img2[:, :, 0])
+        self.assertItemsEqual(stack.calculate().img,
+                              np.maximum(img, img2)[:, :, 0])
+
     def test_mean_stack(self):
         stack = Stack('mean', 3)
         self.assertEqual(stack.mode, 'mean')
@@ -62,6 +89,80 @@ class TestStack(unittest.TestCase):
         self.assertTrue(result[1, 1, 1] == 32767)
         self.assertTrue(result.max() == 65535)
 
+    def test_mean_calculate(self):
+        for kwargs in (None, {'compensated': True}):
+            stack = Stack('mean', 3, kwargs=kwargs)
+            stack.add_image(self.img1)
+            stack.add_image(self.img4)
+            stack.add_image(self.img2.img.astype(np.uint8))
+            self.assertItemsEqual(stack.stack.img, 8 * np.ones((3, 3, 3)))
+            self.assertItemsEqual(stack.calculate().img,
+                                  8 / 3. * np.ones((3, 3, 3)))
+        # The added images are not modified
+        self.assertEqual(self.img2.img.dtype, np.float)
+
+        data = np.zeros((1, 1), dtype=np.float) + 0.1
+        plain = Stack('mean', 10000)
+        comp = Stack('mean', 10000, kwargs={'compensated': True})
+        plain.add_image(np.zeros((1, 1)) + 1e8)
+        comp.add_image(np.zeros((1, 1)) + 1e8)
+        for i in range(10000):
+            plain.add_image(data)
+            comp.add_image(data)
+        self.assertAlmostEqual(comp.stack.img[0, 0] - 1e8, 1000., 5)
+        self.assertTrue(abs(comp.stack.img[0, 0] - 1e8 - 1000.) <
+                        abs(plain.stack.img[0, 0] - 1e8 - 1000.))
+
+    def test_wmean_stack(self):
+        stack = Stack('wmean', 3)
+        self.assertEqual(stack.mode, 'wmean')
+        stack.add_image(self.img2, weight=0.5)
+        stack.add_image(self.img4, weight=0.25)
+        stack.add_image(self.img3)
+        self.assertEqual(stack._num, 3)
+        self.assertEqual(stack._weight_sum, 1.75)
+        self.assertItemsEqual(stack.calculate().img,
+                              (0.5 + 1.75 + 2) / 1.75 * np.ones((3, 3, 3)))
+        self.assertRaises(ValueError, stack.add_image, self.img2, -1)
+        stack = Stack('wmean', 1)
+        stack.add_image(self.img2, weight=0)
+        self.assertRaises(ValueError, stack.calculate)
+
+    def test_std_stack(self):
+        data = np.random.rand(4, 5, 3, 10) * 100
+        for mode, func in (('std', np.std), ('var', np.var)):
+            stack = Stack(mode, 10)
+            self.assertTrue(stack.noise() is None)
+            for i in range(data.shape[-1]):
+                stack.add_image(data[:, :, :, i])
+            self.assertTrue(np.allclose(stack.calculate().img,
+                                        func(data, -1)))
+            self.assertTrue(np.allclose(stack.stack.img, np.mean(data, -1)))
+            self.assertTrue(np.allclose(stack.noise().img, np.std(data, -1)))
+        self.assertTrue(self.median.noise() is None)
+
+    def test_stack_set(self):
+        data = np.random.randint(0, 255, (4, 5, 3, 6)).astype(np.uint8)
+        modes = ('min', 'max', 'mean', 'median', 'std')
+        stacks = StackSet()
+        for mode in modes:
+            stacks.append(Stack(mode, 6))
+        self.assertEqual(len(stacks), 5)
+        singles = [Stack(mode, 6) for mode in modes]
+        for i in range(data.shape[-1]):
+            stacks.add_image(Image(img=data[:, :, :, i]))
+            for stack in singles:
+                stack.add_image(data[:, :, :, i])
+        for res1, res2 in zip(stacks.calculate(),
+                              [stack.calculate() for stack in singles]):
+            self.assertItemsEqual(res1.img, res2.img)
+        self.assertEqual([stack.mode for stack in stacks], list(modes))
+
+        frame = _Frame(data[:, :, :, 0])
+        self.assertTrue(frame.luminance() is frame.luminance())
+        self.assertTrue(frame.astype(np.float) is frame.astype(np.float))
+        self.assertTrue(frame.astype(np.uint8) is frame.data)
+
     def test_median_stack(self):
         stack = Stack('median', 3)
         self.assertEqual(stack.mode, 'median')
@@ -92,6 +193,163 @@ class TestStack(unittest.TestCase):
         self.assertItemsEqual(result, 1./3. + 3 * np.ones((3, 3, 3),
                                                           dtype=np.uint16))
 
+    def test_deep_storage(self):
+        stack = Stack('median', 3, kwargs={'dtype': 'uint16'})
+        stack.add_image(self.img1)
+        stack.add_image(self.img4)
+        self.assertEqual(stack.stack.shape, (3, 3, 3, 3))
+        self.assertEqual(stack.stack.dtype, np.uint16)
+        self.assertItemsEqual(stack.stack[1], 7 * np.ones((3, 3, 3)))
+        stack.add_image(np.zeros((3, 3, 3)) + 70000.4)
+        self.assertItemsEqual(stack.stack[2], 65535 * np.ones((3, 3, 3)))
+        result = stack.calculate().img
+        self.assertEqual(result.dtype, np.uint16)
+        self.assertItemsEqual(result, 7 * np.ones((3, 3, 3)))
+
+        # Floating point images are scaled to the storage range
+        data = np.random.random((4, 5, 3, 7)) + 0.01
+        for mode, func in (('median', lambda x: np.median(x, -1)),
+                           ('sigma', lambda x: np.mean(x, -1))):
+            for disk in (False, True):
+                stack = Stack(mode, 7, kwargs={'dtype': 'uint16',
+                                               'disk': disk,
+                                               'kappa': 10.})
+                for i in range(7):
+                    stack.add_image(data[:, :, :, i])
+                self.assertTrue(stack.stack.max() > 2**14)
+                result = stack.calculate().img
+                self.assertEqual(result.dtype, np.float64)
+                self.assertTrue(np.allclose(result, func(data),
+                                            atol=1e-4))
+
+        # Grayscale images
+        for kwargs in (None, {'disk': True}):
+            stack = Stack('median', 3, kwargs=kwargs)
+            for i in range(3):
+                stack.add_image(np.zeros((4, 5), dtype=np.uint8) + i)
+            result = stack.calculate().img
+            self.assertItemsEqual(result, np.ones((4, 5), dtype=np.uint8))
+
+    def test_sigma_worker(self):
+        data = np.array([[[1, 2, 2, 2, 3, 0, 50],
+                          [0, 0, 0, 0, 0, 0, 0],
+                          [4, 4, 4, 4, 4, 4, 4]]], dtype=np.uint16)
+        result = _sigma_worker(np.rollaxis(data, 2), 2., 5)
+        self.assertEqual(result.shape, (1, 3))
+        self.assertAlmostEqual(result[0, 0], 2.)
+        self.assertEqual(result[0, 1], 0)
+        self.assertEqual(result[0, 2], 4)
+        # No rejection
+        result = _sigma_worker(np.rollaxis(data, 2), 10., 5)
+        self.assertAlmostEqual(result[0, 0], 60 / 6.)
+
+        stack = Stack('sigma', 7, nprocs=2, kwargs={'kappa': 2.,
+                                                    'max_iters': 5})
+        for i in range(7):
+            stack.add_image(np.tile(data[:, :1, i:i+1], (2, 4, 3)))
+        self.assertItemsEqual(stack.calculate().img,
+                              2 * np.ones((2, 4, 3), dtype=np.uint16))
+
+    def test_deep_tiles(self):
+        # every thread gets a tile channel also for small images
+        data = np.random.randint(1, 100, (11, 6, 3, 9)).astype(np.uint8)
+        for kwargs in (None, {'disk': True, 'memory': 1}):
+            stack = Stack('sigma', 9, nprocs=8, kwargs=kwargs)
+            for i in range(data.shape[-1]):
+                stack.add_image(data[:, :, :, i])
+            tiles = list(stack._deep_tiles())
+            self.assertTrue(3 * len(tiles) >= 8)
+            self.assertEqual(tiles[0][0], 0)
+            self.assertEqual(tiles[-1][1], 11)
+            for i in range(1, len(tiles)):
+                self.assertEqual(tiles[i][0], tiles[i-1][1])
+
+    def test_parallel_calculate(self):
+        data = np.random.randint(1, 100, (11, 6, 3, 9))
+        for mode in ('median', 'sigma', 'approx_median'):
+            for kwargs in (None, {'disk': True, 'memory': 0}):
+                if mode == 'approx_median' and kwargs is not None:
+                    continue
+                results = []
+                for nprocs in (1, 3):
+                    stack = Stack(mode, 9, nprocs=nprocs, kwargs=kwargs)
+                    for i in range(data.shape[-1]):
+                        stack.add_image(data[:, :, :, i].astype(np.uint8))
+                    results.append(stack.calculate().img)
+                self.assertItemsEqual(results[0], results[1])
+
+        stack = Stack('median', 9, nprocs=2)
+        stack._img_shape = (4, 2, 1)
+        tiles = [(i, i+1, [np.zeros((1, 2)) + i]) for i in range(4)]
+        result = stack._map_tiles(lambda x: 2 * x, iter(tiles), np.float)
+        self.assertItemsEqual(result.img[:, 1, 0], np.array([0, 2, 4, 6.]))
+
+    def test_disk_stacks(self):
+        data = np.random.randint(1, 100, (7, 5, 3, 9))
+        for mode in ('median', 'sigma'):
+            mem_stack = Stack(mode, 9)
+            disk_stack = Stack(mode, 9, kwargs={'disk': True, 'memory': 0})
+            for i in range(data.shape[-1]):
+                mem_stack.add_image(data[:, :, :, i].astype(np.float))
+                disk_stack.add_image(data[:, :, :, i].astype(np.float))
+            self.assertEqual(disk_stack._tile_rows, 1)
+            self.assertEqual(disk_stack.stack.shape, (7, 9, 1, 5, 3))
+            self.assertItemsEqual(disk_stack.calculate().img,
+                                  mem_stack.calculate().img)
+        stack = Stack('median', 2, kwargs={'disk': True})
+        stack.add_image(self.img1)
+        stack.add_image(self.img3)
+        self.assertEqual(stack._tile_rows, 3)
+        self.assertItemsEqual(stack.calculate().img,
+                              np.ones((3, 3, 3), dtype=np.float))
+
+    def test_approx_median_stack(self):
+        stack = Stack('approx_median', 3, kwargs={'range': (-0.5, 9.5),
+                                                  'bins': 10})
+        self.assertEqual(stack.mode, 'approx_median')
+        stack.add_image(self.img1)
+        stack.add_image(self.img4)
+        stack.add_image(self.img3)
+        self.assertEqual(stack.stack.shape, (3, 3, 3, 10))
+        self.assertEqual(stack.stack.dtype, np.uint8)
+        self.assertItemsEqual(stack.stack.sum(-1), 3 * np.ones((3, 3, 3)))
+        self.assertItemsEqual(stack.calculate().img,
+                              2 * np.ones((3, 3, 3), dtype=np.float))
+
+        # Integer data, compare to exact median
+        data = np.random.randint(0, 256, (20, 10, 3, 15)).astype(np.uint8)
+        stack = Stack('approx_median', 15, kwargs={'bins': 32})
+        for i in range(data.shape[-1]):
+            stack.add_image(data[:, :, :, i])
+        self.assertEqual(stack._hist_range, (-0.5, 255.5))
+        result = stack.calculate().img
+        self.assertEqual(result.shape, (20, 10, 3))
+        self.assertTrue(np.all(np.abs(result - np.median(data, -1)) <=
+                               256 / 32.))
+
+        # Default number of bins follows the data type
+        stack = Stack('approx_median', 15)
+        stack.add_image(data[:, :, :, 0])
+        self.assertEqual(stack.stack.shape[-1], 16)
+        stack = Stack('approx_median', 15)
+        stack.add_image(data[:, :, :, 0].astype(np.uint16))
+        self.assertEqual(stack.stack.shape[-1], 30)
+
+        # Range of floating point data is widened when needed
+        data = np.random.random((20, 10, 3, 15))
+        data[:, :, :, 5:] *= 4
+        data[:, :, :, 10:] -= 2
+        stack = Stack('approx_median', 15, kwargs={'bins': 64})
+        for i in range(data.shape[-1]):
+            stack.add_image(data[:, :, :, i])
+        self.assertTrue(stack._hist_range[0] <= data.min())
+        self.assertTrue(stack._hist_range[1] >= data.max())
+        self.assertTrue(np.all(stack.stack.sum(-1) == 15))
+        width = (stack._hist_range[1] - stack._hist_range[0]) / 64.
+        result = stack.calculate().img
+        self.assertTrue(np.all(np.abs(result - np.median(data, -1)) <=
+                               width))
+
     def assertItemsEqual(self, a, b):
         if isinstance(a, np.ndarray):
             self.assertTrue(np.all(a == b))